@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy
+from PIL import Image
+
+import clean_caps
+import navigate_caps
+import pack_caps
+import view_caps
+
+
+# image sizes in the corpus, small ones are the most common
+IMAGE_SIZES = [(320, 240)] * 4 + [(1280, 720)] * 3 + [(1920, 1080)] * 2 + [(4000, 3000)]
+WORDS = "the a of cap caption album image text photo night city river old new red blue green light dark small large".split()
+
+# window the headless get_frame benchmarks render into
+WINDOW = (1280, 720)
+
+
+def make_image(rng, size, fmt):
+    # smooth colour gradient with a little noise, so files have realistic sizes for their format.
+    # Big images are drawn at around 1000 pixels wide and scaled up, to keep generation cheap.
+    w,h = size
+    shrink = max(1, w // 1000)
+    sw,sh = w // shrink, h // shrink
+    x = numpy.linspace(0, 1, sw, dtype=numpy.float32)
+    y = numpy.linspace(0, 1, sh, dtype=numpy.float32)[:, None]
+    base = rng.random(3) * 255
+    img = numpy.empty((sh, sw, 3), numpy.float32)
+    img[..., 0] = base[0] * x
+    img[..., 1] = base[1] * y
+    img[..., 2] = base[2] * (1 - x) * (1 - y)
+    img += rng.normal(0, 8, (sh, sw, 1)).astype(numpy.float32)
+
+    image = Image.fromarray(numpy.clip(img, 0, 255).astype(numpy.uint8))
+    if shrink > 1:
+        image = image.resize((w, h), Image.BILINEAR)
+    out = io.BytesIO()
+    image.save(out, fmt, quality=90)
+    return out.getvalue()
+
+def make_gif(rng, frames):
+    w,h = 320, 240
+    images = []
+    for i in range(frames):
+        img = numpy.zeros((h, w, 3), numpy.uint8)
+        img[:, :, 0] = (i * 255) // frames
+        x = (i * w) // frames
+        img[h//3:2*h//3, x:x + w//8] = rng.integers(0, 255, 3)
+        images.append(Image.fromarray(img))
+
+    out = io.BytesIO()
+    images[0].save(out, "GIF", save_all=True, append_images=images[1:], duration=40, loop=0)
+    return out.getvalue()
+
+def make_text(rng):
+    return bytes(" ".join(rng.choice(WORDS, rng.integers(5, 80))), "utf-8")
+
+def make_caps(count, seed):
+    # CapData and AlbumData for a mixed corpus: images, texts, captions, albums, animated GIFs,
+    # and re-encoded copies of earlier images for the duplicate scan to find
+    rng = numpy.random.default_rng(seed)
+    caps = []
+    images = []
+    for sequence in range(1, count + 1):
+        kind = rng.choice(['image', 'text', 'caption', 'album', 'gif', 'duplicate'], p=[0.3, 0.1, 0.3, 0.15, 0.05, 0.1])
+
+        if kind == 'album':
+            cap = pack_caps.AlbumData(sequence)
+            for _ in range(rng.integers(2, 11)):
+                img_data = make_image(rng, IMAGE_SIZES[rng.integers(0, 7)], "JPEG") if rng.random() < 0.8 else None
+                txt_data = make_text(rng) if img_data is None or rng.random() < 0.5 else None
+                cap.append(img_data, txt_data)
+            caps.append(cap)
+            continue
+
+        cap = pack_caps.CapData(sequence)
+        if kind == 'text':
+            cap.append(None, make_text(rng))
+        elif kind == 'gif':
+            cap.append(make_gif(rng, int(rng.integers(10, 31))), None)
+        elif kind == 'duplicate' and images:
+            original = Image.open(io.BytesIO(images[rng.integers(0, len(images))]))
+            out = io.BytesIO()
+            original.save(out, "JPEG", quality=75)
+            cap.append(out.getvalue(), make_text(rng) if rng.random() < 0.5 else None)
+        else:
+            size = IMAGE_SIZES[rng.integers(0, len(IMAGE_SIZES))]
+            img_data = make_image(rng, size, "JPEG" if rng.random() < 0.8 else "PNG")
+            images.append(img_data)
+            cap.append(img_data, make_text(rng) if kind == 'caption' else None)
+        caps.append(cap)
+    return caps
+
+def cap_bytes(cap):
+    if isinstance(cap, pack_caps.AlbumData):
+        return sum(cap_bytes(member) for member in cap.caps)
+    return len(cap.img_data or b"") + len(cap.txt_data or b"")
+
+
+def timings(samples):
+    # milliseconds, summarised
+    ms = sorted(s * 1000 for s in samples)
+    if not ms:
+        return None
+    return {
+        "median": round(statistics.median(ms), 3),
+        "p95": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 3),
+        "mean": round(statistics.mean(ms), 3),
+        "n": len(ms),
+    }
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_pack(caps, workdir):
+    results = {}
+    totalBytes = sum(cap_bytes(cap) for cap in caps)
+    for dedup in [False, True]:
+        dirname = os.path.join(workdir, "pack_dedup" if dedup else "pack")
+        os.makedirs(dirname)
+        pack_caps.DEDUP = dedup
+        start = time.perf_counter()
+        for cap in caps:
+            cap.pack(dirname)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        pack_caps.DEDUP = False
+
+        name = "dedup" if dedup else "plain"
+        results[name + "_caps_per_sec"] = round(len(caps) / elapsed, 2)
+        results[name + "_mb_per_sec"] = round(totalBytes / 1e6 / elapsed, 2)
+    return results
+
+def bench_startup(dirname, repeat):
+    # lazy mode only helps a start from a named file (the viewer's bookmark), random and first-file starts wait for the listing
+    files = sorted(entry.path for entry in os.scandir(dirname) if entry.is_file())
+    bookmark = files[len(files) // 2]
+    lazy = []
+    lazyRandom = []
+    full = []
+    for _ in range(repeat):
+        elapsed,nav = timed(lambda: navigate_caps.FileNavigator(dirname, in_memory=True, lazy=True))
+        lazy.append(elapsed + timed(nav.get_file_from_name, bookmark)[0])
+        nav.sync_listing()
+        nav.close_zip()
+
+        elapsed,nav = timed(lambda: navigate_caps.FileNavigator(dirname, in_memory=True, lazy=True))
+        lazyRandom.append(elapsed + timed(nav.get_random_file)[0])
+        nav.close_zip()
+
+        elapsed,nav = timed(lambda: navigate_caps.FileNavigator(dirname, in_memory=True))
+        full.append(elapsed + timed(nav.get_first_file)[0])
+        nav.close_zip()
+    return {"lazy_bookmark_cap_ms": timings(lazy), "lazy_random_cap_ms": timings(lazyRandom), "full_listing_ms": timings(full)}
+
+def bench_navigation(dirname, steps):
+    results = {}
+    for in_memory in [True, False]:
+        mode = "memory" if in_memory else "extract"
+        nav = navigate_caps.FileNavigator(dirname, in_memory=in_memory)
+        nav.get_first_file()
+        count = min(steps, len(nav.files))
+
+        results["next_" + mode + "_ms"] = timings([timed(nav.get_next)[0] for _ in range(count)])
+        results["prev_" + mode + "_ms"] = timings([timed(nav.get_prev)[0] for _ in range(count)])
+
+        # what a key press costs in the viewer without prefetching: resolve the cap, decode and render it
+        render = []
+        for _ in range(count):
+            start = time.perf_counter()
+            imgfile,_ = nav.get_next()
+            view_caps.MediaManager(imgfile).get_frame(*WINDOW)
+            render.append(time.perf_counter() - start)
+        results["next_render_" + mode + "_ms"] = timings(render)
+
+        # album member switches, over every album in the corpus
+        switches = []
+        for filename in list(nav.files):
+            nav.get_file_from_name(filename)
+            if nav.isSeq():
+                switches.extend(timed(nav.get_next_seq)[0] for _ in range(len(nav.subfiles)))
+        results["album_switch_" + mode + "_ms"] = timings(switches)
+        nav.close_zip()
+        nav.wipe_tmp()
+    return results
+
+def frames_per_sec(media, frames, change = None):
+    start = time.perf_counter()
+    for i in range(frames):
+        if change is not None:
+            change(media, i)
+        media.get_frame(*WINDOW)
+    return round(frames / max(time.perf_counter() - start, 1e-9), 2)
+
+def pan(media, i):
+    # alternate between two scroll positions, so every frame is rendered again
+    media.set_scrollX(0 if i % 2 else 40, WINDOW[0])
+
+def bench_get_frame(rng, frames):
+    workdir = tempfile.mkdtemp(prefix="bench_frames_")
+    try:
+        files = {}
+        for name, data in [("medium.jpg", make_image(rng, (1920, 1080), "JPEG")),
+                           ("large.jpg", make_image(rng, (8000, 6000), "JPEG")),
+                           ("anim.gif", make_gif(rng, 30))]:
+            files[name] = os.path.join(workdir, name)
+            with open(files[name], "wb") as file:
+                file.write(data)
+
+        results = {}
+        results["still_cached_fps"] = frames_per_sec(view_caps.MediaManager(files["medium.jpg"]), frames)
+        results["still_pan_fps"] = frames_per_sec(view_caps.MediaManager(files["medium.jpg"]), frames, pan)
+        results["animated_fps"] = frames_per_sec(view_caps.MediaManager(files["anim.gif"]), frames)
+
+        media = view_caps.MediaManager(files["large.jpg"])
+        media.scale = 0.2
+        results["large_zoomed_out_open_ms"] = round(timed(media.get_frame, *WINDOW)[0] * 1000, 3)
+        results["large_zoomed_out_pan_fps"] = frames_per_sec(media, frames, pan)
+
+        media = view_caps.MediaManager(files["large.jpg"])
+        results["large_full_open_ms"] = round(timed(media.get_frame, *WINDOW)[0] * 1000, 3)
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+def bench_dedup(dirname, jobs):
+    # cold scan without the hash cache, output of the scan itself is dropped
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed,_ = timed(clean_caps.cleanDirectory, dirname, 6, False, None, jobs)
+    count = sum(1 for entry in os.scandir(dirname) if entry.is_file())
+    return {"scan_files_per_sec": round(count / max(elapsed, 1e-9), 2), "jobs": jobs}
+
+
+def run(count, seed, steps, frames, jobs, repeat):
+    rng = numpy.random.default_rng(seed)
+    workdir = tempfile.mkdtemp(prefix="bench_caps_")
+    try:
+        print("Generating", count, "caps...")
+        caps = make_caps(count, seed)
+
+        results = {}
+        print("Packing...")
+        results["pack"] = bench_pack(caps, workdir)
+        corpus = os.path.join(workdir, "pack")
+
+        print("Navigator startup...")
+        results["startup"] = bench_startup(corpus, repeat)
+        print("Navigation...")
+        results["navigation"] = bench_navigation(corpus, steps)
+        print("get_frame...")
+        results["get_frame"] = bench_get_frame(rng, frames)
+        print("Duplicate scan...")
+        results["dedup"] = bench_dedup(corpus, jobs)
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def flatten(results, prefix = ""):
+    out = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            out.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix + key] = value
+    return out
+
+def compare(old, new):
+    # times (_ms) are better lower, rates better higher; only medians and plain numbers are compared
+    oldFlat = flatten(old["results"])
+    newFlat = flatten(new["results"])
+    print("%-50s %12s %12s %9s" % ("metric", "old", "new", "change"))
+    for key in sorted(newFlat):
+        if key not in oldFlat or key.endswith((".p95", ".mean", ".n", ".jobs")):
+            continue
+        before,after = oldFlat[key], newFlat[key]
+        change = (after - before) / before * 100 if before else 0.0
+        lowerIsBetter = "_ms." in key or key.endswith("_ms")
+        better = (change < 0) == lowerIsBetter
+        verdict = "" if abs(change) < 5 else ("better" if better else "WORSE")
+        print("%-50s %12.3f %12.3f %+8.1f%% %s" % (key, before, after, change, verdict))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark navigation, rendering, packing and duplicate scanning on a synthetic corpus.")
+    parser.add_argument('--count', type=int, default=200, help='Number of caps in the generated corpus')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the corpus, the same seed always generates the same corpus')
+    parser.add_argument('--steps', type=int, default=200, help='Number of next/prev moves timed')
+    parser.add_argument('--frames', type=int, default=200, help='Number of frames rendered for each get_frame measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times navigator startup is timed')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of processes for the duplicate scan')
+    parser.add_argument('--output', default='bench.json', help='JSON file the results are written to')
+    parser.add_argument('--compare', default=None, help='Results JSON of an earlier run to compare against')
+
+    args = parser.parse_args()
+
+    results = run(args.count, args.seed, args.steps, args.frames, args.jobs, args.repeat)
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "count": args.count,
+            "seed": args.seed,
+            "steps": args.steps,
+            "frames": args.frames,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print("Results written to", args.output)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            compare(json.load(file), report)
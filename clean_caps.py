@@ -1,23 +1,353 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import time
+
+import numpy
+from PIL import Image
+from PIL import ImageFile
+ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 import navigate_caps
+import pack_caps
 import view_caps
 
 
-def cleanDirectory(dirname):
-    fileNav = navigate_caps.FileNavigator(dirname)
-    for imgfile,txtfile in fileNav:
-        # get hash of imgfile and sqash-case of txtfile
-        # iterate through the rest of the directory, keeping a list of files that match either
-        # open a cap viewer on that list, allowing the user to delete duplicates if necessary
+# size of the DCT used for pHash, only the lowest 8x8 frequencies are kept
+DCT_SIZE = 32
+DCT = numpy.array([[numpy.cos(numpy.pi * (2*x + 1) * u / (2 * DCT_SIZE)) for x in range(DCT_SIZE)] for u in range(DCT_SIZE)])
+
+
+def bits_to_int(bits):
+    return int.from_bytes(numpy.packbits(bits.flatten()).tobytes(), 'big')
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def dhash(image):
+    small = numpy.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=numpy.int16)
+    return bits_to_int(small[:, 1:] > small[:, :-1])
+
+def phash(image):
+    small = numpy.asarray(image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR), dtype=numpy.float64)
+    coeffs = (DCT @ small @ DCT.T)[:8, :8].flatten()
+    # the DC term only reflects overall brightness, so it is left out of the median
+    return bits_to_int(coeffs > numpy.median(coeffs[1:]))
+
+def squash(text):
+    return re.sub(r'[^a-z0-9]', '', text.lower())
+
+
+def read_bytes(file):
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return f.read()
+    file.seek(0)
+    return file.read()
+
+
+class CapHash:
+    def __init__(self, filename, member = None):
+        self.filename = filename
+        self.member = member
+        self.content = None
+        self.dhash = None
+        self.phash = None
+        self.text = None
+
+    def hash_image(self, raw_data):
+        self.content = hashlib.sha1(raw_data).hexdigest()
+        try:
+            with Image.open(io.BytesIO(raw_data)) as image:
+                self.dhash = dhash(image)
+                self.phash = phash(image)
+        except Exception:
+            # videos and anything else PIL can't open only get a content hash
+            pass
+
+    def hash_text(self, raw_data):
+        squashed = squash(raw_data.decode("utf-8", errors="replace"))
+        if squashed:
+            self.text = hashlib.sha1(squashed.encode("utf-8")).hexdigest()
+
+
+def hash_cap(filename, member, imgfile, txtfile, resource_dir):
+    cap = CapHash(filename, member)
+
+    # blank.jpg and empty.txt stand in for the missing half of a cap, they aren't content
+    if not (isinstance(imgfile, str) and os.path.dirname(imgfile) == resource_dir):
+        cap.hash_image(read_bytes(imgfile))
+    if not (isinstance(txtfile, str) and os.path.dirname(txtfile) == resource_dir):
+        cap.hash_text(read_bytes(txtfile))
+
+    return cap
+
+
+def hash_file(filename, resource_dir):
+    # hashes for a top level cap, or one per member if it is an album (read through a single zip handle)
+    nav = navigate_caps.FileNavigator(filelist=[filename], in_memory=True)
+    imgfile,txtfile = nav.get_first_file()
+    caps = [hash_cap(filename, nav.get_sub_filename_if_seq(), imgfile, txtfile, resource_dir)]
+
+    for _ in range(1, len(nav.subfiles)):
+        imgfile,txtfile = nav.get_next_seq()
+        caps.append(hash_cap(filename, nav.get_sub_filename_if_seq(), imgfile, txtfile, resource_dir))
+
+    nav.close_zip()
+    return caps
+
+def hash_job(job):
+    # worker entry point, errors are sent back with the filename instead of killing the pool
+    filename,resource_dir = job
+    try:
+        return filename, hash_file(filename, resource_dir), None
+    except Exception as e:
+        return filename, None, str(e)
+
+
+def hex_or_none(value):
+    return None if value is None else "%016x" % value
+
+def int_or_none(value):
+    return None if value is None else int(value, 16)
+
+
+class HashCache:
+    # SQLite store of cap hashes keyed by path, size and mtime, so unchanged files are never decoded twice
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("""create table if not exists cap_hashes (
+            path text not null,
+            member text not null,
+            size integer not null,
+            mtime integer not null,
+            content text,
+            dhash text,
+            phash text,
+            text text,
+            primary key (path, member))""")
+        self.pending = 0
+
+    def stat(self, filename):
+        st = os.stat(filename)
+        return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+
+    def get(self, filename):
+        path,size,mtime = self.stat(filename)
+        rows = self.cursor.execute("select member, size, mtime, content, dhash, phash, text from cap_hashes where path = ? order by rowid", (path,)).fetchall()
+        if not rows or any(row[1] != size or row[2] != mtime for row in rows):
+            return None
+
+        caps = []
+        for member,_,_,content,dh,ph,text in rows:
+            cap = CapHash(filename, member or None)
+            cap.content = content
+            cap.dhash = int_or_none(dh)
+            cap.phash = int_or_none(ph)
+            cap.text = text
+            caps.append(cap)
+        return caps
+
+    def put(self, filename, caps):
+        path,size,mtime = self.stat(filename)
+        self.cursor.execute("delete from cap_hashes where path = ?", (path,))
+        self.cursor.executemany("insert into cap_hashes values (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(path, cap.member or "", size, mtime, cap.content, hex_or_none(cap.dhash), hex_or_none(cap.phash), cap.text) for cap in caps])
+
+        # commit every so often so an interrupted scan keeps most of its work
+        self.pending += 1
+        if self.pending >= 1000:
+            self.connection.commit()
+            self.pending = 0
+
+    def prune(self, dirname, filenames):
+        # only files of the directory just scanned, one cache can serve several directories
+        root = os.path.abspath(dirname)
+        keep = set(os.path.abspath(f) for f in filenames)
+        rows = self.cursor.execute("select distinct path from cap_hashes where path >= ? and path < ?",
+            (root + os.sep, root + chr(ord(os.sep) + 1))).fetchall()
+        stale = [row for row in rows if os.path.dirname(row[0]) == root and row[0] not in keep]
+        self.cursor.executemany("delete from cap_hashes where path = ?", stale)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class BKTree:
+    # Metric tree over hamming distance, lookups only visit children within radius of the query
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            dist = hamming(value, node[0])
+            if dist == 0:
+                node[1].append(item)
+                return
+            if dist not in node[2]:
+                node[2][dist] = (value, [item], {})
+                return
+            node = node[2][dist]
+
+    def find(self, value, radius):
+        out = []
+        if self.root is None:
+            return out
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            dist = hamming(value, node[0])
+            if dist <= radius:
+                out.extend(node[1])
+            for childDist, child in node[2].items():
+                if dist - radius <= childDist <= dist + radius:
+                    stack.append(child)
+        return out
+
+
+class DuplicateIndex:
+    def __init__(self, distance = 6):
+        self.distance = distance
+        self.caps = []
+        self.parent = []
+
+        self.files = {}
+        self.contents = {}
+        self.texts = {}
+        self.tree = BKTree()
+
+    def find_root(self, idx):
+        while self.parent[idx] != idx:
+            self.parent[idx] = self.parent[self.parent[idx]]
+            idx = self.parent[idx]
+        return idx
+
+    def union(self, a, b):
+        self.parent[self.find_root(a)] = self.find_root(b)
+
+    def add(self, cap):
+        idx = len(self.caps)
+        self.caps.append(cap)
+        self.parent.append(idx)
+
+        # members of one album end up in the same group, so no file is listed in two groups
+        self.union(idx, self.files.setdefault(cap.filename, idx))
+        if cap.content is not None:
+            self.union(idx, self.contents.setdefault(cap.content, idx))
+        if cap.text is not None:
+            self.union(idx, self.texts.setdefault(cap.text, idx))
+
+        if cap.phash is not None:
+            # pHash finds the candidates, dHash has to agree before they count as duplicates
+            for other in self.tree.find(cap.phash, self.distance):
+                if hamming(cap.dhash, self.caps[other].dhash) <= 2 * self.distance:
+                    self.union(idx, other)
+            self.tree.add(cap.phash, idx)
+
+    def groups(self):
+        # lists of distinct files that share a duplicate, each file is in at most one list
+        byRoot = {}
+        for idx, cap in enumerate(self.caps):
+            files = byRoot.setdefault(self.find_root(idx), [])
+            if cap.filename not in files:
+                files.append(cap.filename)
+        return [files for files in byRoot.values() if len(files) > 1]
+
+
+def cleanDirectory(dirname, distance = 6, review = True, cachefile = None, jobs = 1):
+    fileNav = navigate_caps.FileNavigator(dirname, in_memory=True)
+    index = DuplicateIndex(distance)
+    cache = HashCache(cachefile) if cachefile is not None else None
+
+    # cached files go straight into the index, the rest are hashed below
+    todo = []
+    for filename in fileNav.files:
+        try:
+            caps = cache.get(filename) if cache is not None else None
+        except Exception as e:
+            print("Error reading cache for", filename, ":", e)
+            continue
+
+        if caps is None:
+            todo.append((filename, fileNav.resource_dir))
+        else:
+            for cap in caps:
+                index.add(cap)
+
+    print("Hashing", len(todo), "of", len(fileNav.files), "files with", jobs, "jobs")
+
+    pool = concurrent.futures.ProcessPoolExecutor(jobs) if jobs > 1 else None
+    results = pool.map(hash_job, todo, chunksize=8) if pool is not None else map(hash_job, todo)
+
+    # results stream back in order while the workers keep going
+    start = time.time()
+    lastReport = start
+    for done, (filename, caps, error) in enumerate(results, 1):
+        if error is not None:
+            print("Error hashing", filename, ":", error)
+        else:
+            if cache is not None:
+                cache.put(filename, caps)
+            for cap in caps:
+                index.add(cap)
+
+        now = time.time()
+        if now - lastReport >= 2 or done == len(todo):
+            print("    %d/%d files, %.1f files/sec" % (done, len(todo), done / max(now - start, 1e-6)))
+            lastReport = now
+
+    if pool is not None:
+        pool.shutdown()
+
+    if cache is not None:
+        cache.prune(dirname, fileNav.files)
+        cache.close()
+
+    groups = index.groups()
+    print("Found", len(groups), "groups of duplicates")
+    for files in groups:
+        print("    " + ", ".join(files))
+        if review:
+            # files deleted while reviewing earlier groups are left out
+            files = [f for f in files if os.path.exists(f)]
+            if len(files) < 2:
+                continue
+            # open a cap viewer on each group, allowing the user to delete duplicates if necessary
+            view_caps.capViewerFromList(files)
+
+    return groups
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Search collections of images and text for duplicates")
     parser.add_argument('--dirname', default=".", help='The directory to be opened')
+    parser.add_argument('--distance', type=int, default=6, help='Maximum pHash hamming distance (out of 64 bits) for two images to count as duplicates')
+    parser.add_argument('--cache', default=os.path.join(os.path.expanduser("~"), ".cache", "caps", "hashes.db"), help='SQLite file caching hashes between runs, files are only rehashed when their size or mtime changes. One cache can be shared by several directories. Keep it outside dirname.')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help='Hash every file without reading or writing the cache')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of processes decoding and hashing files. Default is the number of cores.')
+    parser.add_argument('--collect-blobs', dest='collect_blobs', action='store_true', help='After reviewing, delete deduplicated image blobs that no cap refers to any more')
+    parser.add_argument('--no-review', dest='no_review', action='store_true', help='Only list the duplicate groups, don\'t open a viewer on them')
 
     args = parser.parse_args()
 
-    cleanDirectory(args.dirname)
+    cachefile = None if args.no_cache else args.cache
+
+    cleanDirectory(args.dirname, args.distance, not args.no_review, cachefile, args.jobs)
+
+    if args.collect_blobs:
+        print("Removed", pack_caps.collect_garbage(args.dirname), "unreferenced blobs")
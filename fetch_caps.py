@@ -0,0 +1,166 @@
+import asyncio
+import atexit
+import concurrent.futures
+import io
+import os
+import random
+import threading
+import urllib.parse
+
+import filetype
+import requests
+
+
+# bytes filetype needs to recognise every type it knows
+SNIFF_BYTES = 262
+CHUNK_SIZE = 64 * 1024
+
+# statuses worth trying again, everything else 4xx/5xx fails straight away
+RETRY_STATUS = [408, 425, 429, 500, 502, 503, 504]
+
+
+class FetchError(Exception):
+    pass
+
+class RetryableFetchError(FetchError):
+    pass
+
+
+def is_media(head):
+    kind = filetype.guess(head)
+    return kind is not None and (kind.mime.startswith('image/') or kind.mime.startswith('video/'))
+
+
+class Fetcher:
+    # Downloads images on an asyncio loop running in its own thread, so plain code can submit URLs and wait on futures.
+    # requests does the HTTP (keep-alive pooling per host) in a thread pool, the loop handles limits, retries and backoff.
+    def __init__(self, jobs = 8, per_host = 4, retries = 3, backoff = 0.5, max_bytes = 200 * 1024 * 1024, timeout = 60):
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(jobs)
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.pool)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        # semaphores belong to the loop, so they are only touched from coroutines
+        self.jobs = jobs
+        self.limit = None
+        self.hostLimits = {}
+
+    def submit(self, url):
+        # concurrent.futures.Future of the downloaded bytes, held in memory, so bulk downloads should use submit_to
+        return asyncio.run_coroutine_threadsafe(self.fetch_bytes(url), self.loop)
+
+    def submit_to(self, url, dest):
+        # concurrent.futures.Future of dest, once the body is streamed into it
+        return asyncio.run_coroutine_threadsafe(self.fetch_to(url, dest), self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.pool.shutdown()
+        self.session.close()
+
+    async def fetch_bytes(self, url):
+        return await self.retry(url, self.download_bytes, url)
+
+    async def fetch_to(self, url, dest):
+        await self.retry(url, self.download_to, url, dest)
+        return dest
+
+    async def retry(self, url, download, *args):
+        # run download in the thread pool under the global and per host limits, retrying transient failures
+        if self.limit is None:
+            self.limit = asyncio.Semaphore(self.jobs)
+        host = urllib.parse.urlsplit(url).netloc
+        hostLimit = self.hostLimits.setdefault(host, asyncio.Semaphore(self.per_host))
+
+        attempt = 0
+        while True:
+            try:
+                async with hostLimit, self.limit:
+                    return await self.loop.run_in_executor(None, download, *args)
+            except RetryableFetchError as e:
+                if attempt >= self.retries:
+                    raise FetchError("Giving up on " + url + " after " + str(attempt + 1) + " attempts: " + str(e))
+                # exponential backoff with jitter, so retries from many downloads don't line up
+                await asyncio.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+                attempt += 1
+
+    def download_bytes(self, url):
+        out_file = io.BytesIO()
+        self.download(url, out_file)
+        return out_file.getvalue()
+
+    def download_to(self, url, dest):
+        try:
+            with open(dest, 'wb') as out_file:
+                self.download(url, out_file)
+        except Exception:
+            self.discard(dest)
+            raise
+
+    def download(self, url, out_file):
+        # Stream the body into out_file, giving up as soon as it's clearly too big or not media. Runs in the thread pool.
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                if response.status_code in RETRY_STATUS:
+                    raise RetryableFetchError("HTTP " + str(response.status_code))
+                if response.status_code >= 400:
+                    raise FetchError("HTTP " + str(response.status_code) + " for " + url)
+
+                length = response.headers.get('Content-Length')
+                if length is not None and length.isdigit() and int(length) > self.max_bytes:
+                    raise FetchError(url + " is " + length + " bytes, over the limit of " + str(self.max_bytes))
+
+                total = 0
+                head = b''
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    total += len(chunk)
+                    if total > self.max_bytes:
+                        raise FetchError(url + " is over the limit of " + str(self.max_bytes) + " bytes")
+
+                    if head is not None:
+                        head += chunk
+                        if len(head) >= SNIFF_BYTES:
+                            if not is_media(head):
+                                raise FetchError(url + " is not an image or video")
+                            head = None
+
+                    out_file.write(chunk)
+
+                # bodies shorter than SNIFF_BYTES
+                if head is not None and not is_media(head):
+                    raise FetchError(url + " is not an image or video")
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableFetchError(str(e))
+
+    def discard(self, dest):
+        if os.path.exists(dest):
+            os.remove(dest)
+
+
+# shared by every one off fetch in the process, so they reuse its session and connections
+shared = None
+shared_lock = threading.Lock()
+
+def fetch(url):
+    # one off download of url into memory
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = Fetcher()
+            atexit.register(shared.close)
+    return shared.submit(url).result()
@@ -1,50 +1,223 @@
+import bisect
+import contextlib
+import filetype
+import io
+import itertools
+import json
 import os
+import random
+import sqlite3
+import threading
 import zipfile
+from PIL import Image
+
+import pack_caps
+
+
+# directory entries listed up front in lazy mode, before the rest are listed in the background
+FIRST_BATCH = 256
+
+# records held at a time by RecordNavigator
+PAGE_SIZE = 64
+
+
+def list_files(entries):
+    # scandir entries know their type, so this doesn't stat every file
+    return [entry.path for entry in entries if entry.is_file()]
+
+
+class FileList:
+    # Sorted file list with O(1) lookup by name and O(1) removal. Positions are slots in the
+    # original list, removed files leave a tombstone (None) until there are enough to compact.
+    def __init__(self, files):
+        self.slots = sorted(files)
+        self.positions = {f: i for i, f in enumerate(self.slots)}
+        self.live = len(self.slots)
+
+    def __len__(self):
+        return self.live
+
+    def __getitem__(self, pos):
+        return self.slots[pos]
+
+    def __contains__(self, filename):
+        return filename in self.positions
+
+    def __iter__(self):
+        return (f for f in self.slots if f is not None)
+
+    def slot_count(self):
+        # positions run up to this, including tombstones
+        return len(self.slots)
+
+    def index(self, filename):
+        try:
+            return self.positions[filename]
+        except KeyError:
+            raise ValueError(filename + " is not in file list")
+
+    def nearest(self, filename):
+        # position of filename or the file that would follow it, only valid before anything is removed
+        return min(bisect.bisect_left(self.slots, filename), len(self.slots) - 1)
+
+    def append(self, filename):
+        self.positions[filename] = len(self.slots)
+        self.slots.append(filename)
+        self.live += 1
+
+    def first(self):
+        return self.step(len(self.slots) - 1, 1)
+
+    def random(self):
+        # tombstones are at most half the slots, so this rarely takes more than a couple of tries
+        while True:
+            pos = random.randint(0, len(self.slots) - 1)
+            if self.slots[pos] is not None:
+                return pos
+
+    def step(self, pos, offset):
+        # move offset live files from pos, wrapping around at either end
+        if self.live == 0:
+            raise IndexError("file list is empty")
+
+        direction = 1 if offset > 0 else -1
+        for _ in range(abs(offset)):
+            pos = (pos + direction) % len(self.slots)
+            while self.slots[pos] is None:
+                pos = (pos + direction) % len(self.slots)
+        return pos
+
+    def skip_removed(self, pos):
+        # first live position at or after pos, without wrapping
+        while pos < len(self.slots) and self.slots[pos] is None:
+            pos += 1
+        return pos
+
+    def remove_at(self, pos):
+        del self.positions[self.slots[pos]]
+        self.slots[pos] = None
+        self.live -= 1
+
+    def compact(self, pos):
+        # drop tombstones once they outnumber live files, returning the new position of pos
+        if len(self.slots) - self.live <= self.live:
+            return pos
+
+        newPos = sum(1 for f in self.slots[:pos] if f is not None)
+        self.slots = [f for f in self.slots if f is not None]
+        self.positions = {f: i for i, f in enumerate(self.slots)}
+        return newPos
 
 
 class FileNavigator:
-    def __init__(self, dirname = None, filelist = None):
+    def __init__(self, dirname = None, filelist = None, in_memory = False, lazy = False, indexfile = None):
         source_dir = os.path.dirname(os.path.realpath(__file__))
         self.tmp_dir = os.path.join(source_dir, "tmp")
         self.resource_dir = os.path.join(source_dir, "resources")
 
+        # in lazy mode self.files starts as the first batch listed, and the full list is swapped in from
+        # pendingFiles once the background listing is done. Only a start from a named file skips the wait
+        self.pendingFiles = None
+        self.listed = threading.Event()
+        self.listed.set()
+
+        self.index = None
+
         if filelist is not None:
-            self.files = filelist
+            self.files = FileList(filelist)
+        elif dirname is not None and indexfile is not None:
+            self.index = DirIndex(indexfile, dirname)
+            self.index.refresh()
+            self.files = FileList(self.index.get_files())
+        elif dirname is not None and lazy:
+            self.start_listing(dirname)
         elif dirname is not None:
-            self.files = [os.path.join(dirname, f) for f in os.listdir(dirname) if os.path.isfile(os.path.join(dirname, f))]
+            with os.scandir(dirname) as entries:
+                self.files = FileList(list_files(entries))
         else:
             raise ValueError("FileNavigator must have either dirname or filelist")
 
-        self.files.sort()
         self.idx = 0
 
         self.albumfile = None
         self.subfiles = []
         self.subIdx = 0
 
+        # in memory mode serves zip members as buffers from a zip handle that stays open
+        self.in_memory = in_memory
+        self.zip = None
+        self.zipname = None
+
+    def start_listing(self, dirname):
+        entries = os.scandir(dirname)
+        first = list(itertools.islice(entries, FIRST_BATCH))
+        self.files = FileList(list_files(first))
+
+        if len(first) < FIRST_BATCH:
+            entries.close()
+        else:
+            self.listed.clear()
+            threading.Thread(target=self.finish_listing, args=(entries, list(self.files)), daemon=True).start()
+
+    def finish_listing(self, entries, files):
+        with entries:
+            files.extend(list_files(entries))
+        self.pendingFiles = FileList(files)
+        self.listed.set()
+
+    def is_listed(self):
+        return self.listed.is_set()
+
+    def sync_listing(self, wait = True):
+        # swap in the full sorted listing, keeping the current file selected
+        if wait:
+            self.listed.wait()
+        if self.pendingFiles is None:
+            return
+
+        current = self.files[self.idx] if self.files else None
+        self.files = self.pendingFiles
+        self.pendingFiles = None
+        if current is not None:
+            self.idx = self.files.nearest(current)
+
     def get_random_file(self):
-        self.idx = random.randint(0, len(self.files) - 1)
+        # scandir order is stable, so picking from the first batch would start in the same few files every
+        # time. A random start waits for the whole listing, lazy mode only speeds up named (bookmark) starts
+        self.sync_listing()
+        self.idx = self.files.random()
         self.wipe_tmp()
         self.wipe_seq_data()
         return self.multiplex(self.files[self.idx])
 
     def get_file_from_name(self, filename):
+        self.sync_listing(False)
+        if filename not in self.files:
+            if not self.is_listed() and os.path.isfile(filename):
+                # show it now, sync_listing finds its place in the full listing later
+                self.files.append(filename)
+            else:
+                self.sync_listing()
+
         self.idx = self.files.index(filename)
         self.wipe_tmp()
         self.wipe_seq_data()
         return self.multiplex(self.files[self.idx])
 
     def get_first_file(self):
-        self.idx = 0
+        # the first file by name can be anywhere in scandir order, so this waits for the whole listing too
+        self.sync_listing()
+        self.idx = self.files.first()
         self.wipe_tmp()
         self.wipe_seq_data()
         return self.multiplex(self.files[self.idx])
 
     def advance(self, wrap = True):
+        self.sync_listing()
         if wrap:
-            self.idx = self.wrap_idx(self.idx+1, len(self.files))
+            self.idx = self.files.step(self.idx, 1)
         else:
-            self.idx += 1
+            self.idx = self.files.skip_removed(self.idx + 1)
 
     def get_current(self):
         self.wipe_tmp()
@@ -56,31 +229,50 @@ class FileNavigator:
         return self.get_current()
 
     def get_prev(self):
-        self.idx = self.wrap_idx(self.idx-1, len(self.files))
+        self.sync_listing()
+        self.idx = self.files.step(self.idx, -1)
         return self.get_current()
 
     def delete(self):
+        self.sync_listing()
+        self.close_zip()
         os.remove(self.files[self.idx])
-        self.files.pop(self.idx)
-        self.idx = self.wrap_idx(self.idx, len(self.files))
+        if self.index is not None:
+            self.index.remove(self.files[self.idx])
+        self.files.remove_at(self.idx)
+        self.idx = self.files.compact(self.files.step(self.idx, 1))
         self.wipe_tmp()
         self.wipe_seq_data()
         return self.multiplex(self.files[self.idx])
 
+    def peek(self, offset):
+        self.sync_listing()
+        return self.files.step(self.idx, offset)
+
+    def jump(self, idx, subIdx = 0, subfiles = []):
+        # move to a cap that was already resolved elsewhere (see read_cap) without reading it again
+        self.wipe_tmp()
+        self.idx = idx
+        self.albumfile = self.files[idx] if subfiles else None
+        self.subfiles = subfiles
+        self.subIdx = subIdx
+
     def advance_seq(self, wrap = True):
         if wrap:
             self.subIdx = self.wrap_idx(self.subIdx+1, len(self.subfiles))
         else:
             self.subIdx += 1
 
+    def peek_seq(self, offset):
+        return (self.subIdx + offset) % len(self.subfiles)
+
     def get_current_seq(self):
         self.wipe_tmp()
 
-        tmp_name = os.path.join(self.tmp_dir, self.subfiles[self.subIdx])
-        with zipfile.ZipFile(self.albumfile) as zip:
-            zip.extract(self.subfiles[self.subIdx], self.tmp_dir)
+        with self.zip_handle(self.albumfile) as zip:
+            member = self.extract(zip, self.subfiles[self.subIdx])
 
-        return self.multiplex(tmp_name)
+        return self.multiplex(member)
 
     def get_next_seq(self):
         self.advance_seq()
@@ -91,22 +283,18 @@ class FileNavigator:
         return self.get_current_seq()
 
     def multiplex(self, filename):
-        _,ext = os.path.splitext(filename)
+        _,ext = os.path.splitext(self.member_name(filename))
         if ext == '.zip':
-            with zipfile.ZipFile(filename) as zip:
-                ziplist = sorted(zip.namelist())
+            with self.zip_handle(filename) as zip:
+                ziplist = self.index_members(filename)
+                if ziplist is None:
+                    ziplist = sorted(zip.namelist())
 
                 # reading caption
                 nonimg = [f for f in ziplist if os.path.splitext(f)[1] == '.txt']
                 img = [f for f in ziplist if os.path.splitext(f)[1] != '.txt']
                 if len(nonimg) == 1 and len(img) == 1:
-                    imgname = os.path.join(self.tmp_dir, img[0])
-                    nonimgname = os.path.join(self.tmp_dir, nonimg[0])
-
-                    zip.extract(nonimg[0], self.tmp_dir)
-                    zip.extract(img[0], self.tmp_dir)
-
-                    return imgname, nonimgname
+                    return self.resolve_ref(self.extract(zip, img[0])), self.extract(zip, nonimg[0])
 
                 # reading album
                 if self.albumfile is not None:
@@ -116,16 +304,71 @@ class FileNavigator:
                 self.albumfile = filename
                 self.subfiles = ziplist
 
-                tmp_name = os.path.join(self.tmp_dir, self.subfiles[self.subIdx])
-                zip.extract(self.subfiles[self.subIdx], self.tmp_dir)
-                return self.multiplex(tmp_name)
+                member = self.extract(zip, self.subfiles[self.subIdx])
+            return self.multiplex(member)
 
         elif ext == '.txt':
             return os.path.join(self.resource_dir, 'blank.jpg'), filename
         else:
-            return filename, os.path.join(self.resource_dir, 'empty.txt')
+            return self.resolve_ref(filename), os.path.join(self.resource_dir, 'empty.txt')
+
+    def resolve_ref(self, filename):
+        # deduplicated images are stored as a ref holding the blob's path relative to the cap directory
+        if not self.member_name(filename).endswith(pack_caps.REF_EXT):
+            return filename
+
+        if isinstance(filename, str):
+            with open(filename, "r") as file:
+                ref = file.read().strip()
+        else:
+            filename.seek(0)
+            ref = filename.read().decode("utf-8").strip()
+        return os.path.join(os.path.dirname(self.files[self.idx]), ref)
+
+    def index_members(self, filename):
+        if self.index is None or not isinstance(filename, str):
+            return None
+        return self.index.get_members(filename)
+
+    @contextlib.contextmanager
+    def zip_handle(self, filename):
+        if self.in_memory and isinstance(filename, str):
+            # the handle is kept by name, size and mtime, so a zip rewritten in place is opened again
+            st = os.stat(filename)
+            key = (filename, st.st_size, st.st_mtime_ns)
+            if self.zipname != key:
+                self.close_zip()
+                self.zip = zipfile.ZipFile(filename)
+                self.zipname = key
+            yield self.zip
+        else:
+            with zipfile.ZipFile(filename) as zip:
+                yield zip
+
+    def close_zip(self):
+        if self.zip is not None:
+            self.zip.close()
+        self.zip = None
+        self.zipname = None
+
+    def extract(self, zip, member):
+        if self.in_memory:
+            buf = io.BytesIO(zip.read(member))
+            buf.name = member
+            return buf
+
+        zip.extract(member, self.tmp_dir)
+        return os.path.join(self.tmp_dir, member)
+
+    def member_name(self, filename):
+        if isinstance(filename, str):
+            return filename
+        return getattr(filename, 'name', '')
 
     def wipe_tmp(self):
+        if self.in_memory:
+            return
+
         for file in os.listdir(self.tmp_dir):
             os.remove(os.path.join(self.tmp_dir, file))
 
@@ -155,6 +398,7 @@ class FileNavigator:
             return None
 
     def __del__(self):
+        self.close_zip()
         self.wipe_tmp()
 
     def __iter__(self):
@@ -179,3 +423,281 @@ class FileNavigator:
 
         return imgname,txtname
 
+
+
+def media_info(file):
+    # (media type, width, height), dimensions are only known for images PIL can open
+    mediatype = filetype.guess_mime(file)
+    try:
+        with Image.open(file) as image:
+            return mediatype, image.size[0], image.size[1]
+    except Exception:
+        return mediatype, None, None
+
+def describe(filename):
+    # (kind, sorted zip members, media type, width, height) of a top level cap
+    _,ext = os.path.splitext(filename)
+    if ext == '.zip':
+        with zipfile.ZipFile(filename) as zip:
+            ziplist = sorted(zip.namelist())
+            nonimg = [f for f in ziplist if os.path.splitext(f)[1] == '.txt']
+            img = [f for f in ziplist if os.path.splitext(f)[1] != '.txt']
+            if len(nonimg) == 1 and len(img) == 1:
+                with zip.open(img[0]) as member:
+                    return ('caption', ziplist) + media_info(member)
+            return 'album', ziplist, None, None, None
+    elif ext == '.txt':
+        return 'text', None, 'text/plain', None, None
+    else:
+        return ('image', None) + media_info(filename)
+
+
+class DirIndex:
+    # SQLite index of a cap directory, rebuilt incrementally from mtimes when the directory changes
+    def __init__(self, indexfile, dirname):
+        self.dirname = dirname
+        self.connection = sqlite3.connect(indexfile)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("""create table if not exists files (
+            path text primary key,
+            dirname text not null,
+            size integer not null,
+            mtime integer not null,
+            kind text not null,
+            members text,
+            mediatype text,
+            width integer,
+            height integer)""")
+        self.cursor.execute("create index if not exists files_dirname on files (dirname, path)")
+        self.cursor.execute("create table if not exists dirs (dirname text primary key, mtime integer not null)")
+        self.connection.commit()
+
+    def refresh(self):
+        # files are only added, removed or renamed through the directory, so an unchanged directory mtime means
+        # the listing is current. Files rewritten in place are caught when they are opened, see get_members
+        dirmtime = os.stat(self.dirname).st_mtime_ns
+        row = self.cursor.execute("select mtime from dirs where dirname = ?", (self.dirname,)).fetchone()
+        if row is not None and row[0] == dirmtime:
+            return
+
+        known = {path: (size, mtime) for path,size,mtime in self.cursor.execute("select path, size, mtime from files where dirname = ?", (self.dirname,))}
+        with os.scandir(self.dirname) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                if known.pop(entry.path, None) != (st.st_size, st.st_mtime_ns):
+                    self.update(entry.path, st)
+
+        # whatever wasn't seen is gone
+        self.cursor.executemany("delete from files where path = ?", [(path,) for path in known])
+        self.cursor.execute("insert or replace into dirs values (?, ?)", (self.dirname, dirmtime))
+        self.connection.commit()
+
+    def update(self, path, st):
+        try:
+            kind,members,mediatype,width,height = describe(path)
+        except Exception as e:
+            # keep it listed, the navigator will read it directly
+            print("Error indexing", path, ":", e)
+            kind,members,mediatype,width,height = 'error', None, None, None, None
+        self.cursor.execute("insert or replace into files values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, self.dirname, st.st_size, st.st_mtime_ns, kind, json.dumps(members) if members is not None else None, mediatype, width, height))
+
+    def get_files(self):
+        # paths compare bytewise in SQLite, which is the same order as sorting them in python
+        rows = self.cursor.execute("select path from files where dirname = ? order by path", (self.dirname,))
+        return [row[0] for row in rows]
+
+    def get_entry(self, path):
+        return self.cursor.execute("select kind, members, mediatype, width, height from files where path = ?", (path,)).fetchone()
+
+    def get_members(self, path):
+        # the file may have changed since the last refresh, so it is described again if it doesn't match
+        row = self.cursor.execute("select size, mtime, members from files where path = ?", (path,)).fetchone()
+        st = os.stat(path)
+        if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+            self.update(path, st)
+            self.connection.commit()
+            row = self.cursor.execute("select size, mtime, members from files where path = ?", (path,)).fetchone()
+        if row[2] is None:
+            return None
+        return json.loads(row[2])
+
+    def remove(self, path):
+        self.cursor.execute("delete from files where path = ?", (path,))
+        self.connection.commit()
+
+
+def read_cap(filename, subIdx = 0):
+    # Resolve one cap into in memory buffers with a private navigator, so it is safe off the main thread
+    nav = FileNavigator(filelist=[filename], in_memory=True)
+    nav.subIdx = subIdx
+    imgfile,txtfile = nav.multiplex(filename)
+    nav.close_zip()
+    return imgfile, txtfile, nav.subfiles
+
+
+class RecordNavigator:
+    # Browses the records of a save_to_db store. Records are paged in id order with keyset queries,
+    # so only one page is held at a time. The entries of the current record (album entries expanded
+    # into their members) are its sub positions, reached with the *_seq moves.
+    def __init__(self, dbfile, dirname = ".", tag = None, title = None):
+        self.dirname = dirname
+        self.resource_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "resources")
+        self.connection = sqlite3.connect(dbfile, timeout=30)
+        self.cursor = self.connection.cursor()
+
+        self.filters = []
+        self.params = []
+        if tag is not None:
+            self.filters.append("exists (select 1 from tags where tags.record_id = records.id and tags.name = ?)")
+            self.params.append(tag)
+        if title is not None:
+            self.filters.append("records.title like ?")
+            self.params.append("%" + title + "%")
+
+        self.page = []
+        self.idx = 0
+        self.positions = []
+        self.subIdx = 0
+
+    def query_page(self, bound = None, forward = True):
+        # the page of matching records after (or before) the id bound, in id order
+        where = list(self.filters)
+        params = list(self.params)
+        if bound is not None:
+            where.append("records.id > ?" if forward else "records.id < ?")
+            params.append(bound)
+
+        sql = "select id, title from records"
+        if where:
+            sql += " where " + " and ".join(where)
+        sql += " order by id " + ("asc" if forward else "desc") + " limit ?"
+        rows = self.cursor.execute(sql, params + [PAGE_SIZE]).fetchall()
+        return rows if forward else rows[::-1]
+
+    def use_page(self, rows, idx):
+        if not rows:
+            raise ValueError("No records match")
+        self.page = rows
+        self.idx = idx
+        return self.get_current()
+
+    def get_random_file(self):
+        # ids have gaps, so this favours records after a gap, which is fine for a random start
+        low,high = self.cursor.execute("select min(id), max(id) from records" + (" where " + " and ".join(self.filters) if self.filters else ""), self.params).fetchone()
+        if low is None:
+            raise ValueError("No records match")
+        return self.use_page(self.query_page(random.randint(low, high) - 1), 0)
+
+    def get_file_from_name(self, filename):
+        row = self.cursor.execute("""select record_entries.record_id from files join record_entries on record_entries.id = files.entry_id
+            where files.filename = ? limit 1""", (filename,)).fetchone()
+        if row is None:
+            return self.get_first_file()
+        return self.use_page(self.query_page(row[0] - 1) or self.query_page(), 0)
+
+    def get_first_file(self):
+        return self.use_page(self.query_page(), 0)
+
+    def get_next(self):
+        if self.idx + 1 < len(self.page):
+            self.idx += 1
+            return self.get_current()
+        return self.use_page(self.query_page(self.page[-1][0]) or self.query_page(), 0)
+
+    def get_prev(self):
+        if self.idx > 0:
+            self.idx -= 1
+            return self.get_current()
+        rows = self.query_page(self.page[0][0], False) or self.query_page(None, False)
+        return self.use_page(rows, len(rows) - 1)
+
+    def get_current(self):
+        self.load_record(self.page[self.idx][0])
+        return self.get_current_seq()
+
+    def load_record(self, record_id):
+        # files of each entry in order, entries without files still get a (blank) position
+        entries = []
+        rows = self.cursor.execute("""select record_entries.id, files.filename from record_entries
+            left join files on files.entry_id = record_entries.id
+            where record_entries.record_id = ? order by record_entries.idx, files.id""", (record_id,))
+        for entry_id, filename in rows:
+            if not entries or entries[-1][0] != entry_id:
+                entries.append((entry_id, []))
+            if filename is not None:
+                entries[-1][1].append(filename)
+
+        self.positions = []
+        for _, files in entries:
+            members = self.album_members(files)
+            if members:
+                self.positions.extend((files, subIdx, member) for subIdx, member in enumerate(members))
+            else:
+                self.positions.append((files, 0, None))
+        if not self.positions:
+            self.positions.append(([], 0, None))
+        self.subIdx = 0
+
+    def album_members(self, files):
+        # members of an entry that is a single album zip, read from the zip directory only
+        if len(files) != 1 or os.path.splitext(files[0])[1] != '.zip':
+            return None
+        try:
+            with zipfile.ZipFile(os.path.join(self.dirname, files[0])) as zip:
+                ziplist = sorted(zip.namelist())
+        except (OSError, zipfile.BadZipFile):
+            return None
+        nonimg = [f for f in ziplist if os.path.splitext(f)[1] == '.txt']
+        if len(nonimg) == 1 and len(ziplist) == 2:
+            return None
+        return ziplist
+
+    def isSeq(self):
+        return len(self.positions) > 1
+
+    def peek_seq(self, offset):
+        return (self.subIdx + offset) % len(self.positions)
+
+    def get_current_seq(self):
+        files,subIdx,_ = self.positions[self.subIdx]
+        paths = [os.path.join(self.dirname, f) for f in files]
+        try:
+            if len(paths) == 1:
+                return read_cap(paths[0], subIdx)[:2]
+
+            # an entry saved as separate files shows its first image and first text together
+            imgs = [f for f in paths if os.path.splitext(f)[1] != '.txt']
+            txts = [f for f in paths if os.path.splitext(f)[1] == '.txt']
+            imgfile = read_cap(imgs[0])[0] if imgs else os.path.join(self.resource_dir, 'blank.jpg')
+            txtfile = read_cap(txts[0])[1] if txts else os.path.join(self.resource_dir, 'empty.txt')
+            return imgfile, txtfile
+        except (OSError, zipfile.BadZipFile) as e:
+            return os.path.join(self.resource_dir, 'blank.jpg'), io.BytesIO(("Can't read entry: " + str(e)).encode("utf-8"))
+
+    def get_next_seq(self):
+        self.subIdx = self.peek_seq(1)
+        return self.get_current_seq()
+
+    def get_prev_seq(self):
+        self.subIdx = self.peek_seq(-1)
+        return self.get_current_seq()
+
+    def get_filename(self):
+        # the first file of the current entry, so it can be passed back to get_file_from_name
+        files = self.positions[self.subIdx][0]
+        return files[0] if files else ""
+
+    def get_sub_filename_if_seq(self):
+        if not self.isSeq():
+            return None
+        files,_,member = self.positions[self.subIdx]
+        return ", ".join(files) + (" / " + member if member is not None else "")
+
+    def get_title(self):
+        return self.page[self.idx][1]
+
+    def close(self):
+        self.connection.close()
@@ -1,34 +1,92 @@
 import shutil
 import os
+import io
 import zipfile
 import datetime
+import hashlib
+import threading
+import time
+import uuid
 import filetype
 
+# Deflate level (0-9) for data written into zips, 0 stores everything. Only text and
+# uncompressed media are deflated, images and videos are already compressed and are stored as is.
+COMPRESS_LEVEL = 6
+DEFLATE_EXTS = ['txt', 'bmp', 'tif', 'psd', 'ico']
+
+# With DEDUP on, images are stored once by content under BLOB_DIR in the cap directory, and the
+# cap gets a small <name>.<ext>.ref file holding the blob's path relative to the cap directory
+DEDUP = False
+BLOB_DIR = '.blobs'
+REF_EXT = '.ref'
+
+last_stamp = None
+stamp_lock = threading.Lock()
+
+def timestamp():
+    # UTC to the microsecond, and never repeating or going backwards within a process
+    global last_stamp
+    with stamp_lock:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if last_stamp is not None and now <= last_stamp:
+            now = last_stamp + datetime.timedelta(microseconds=1)
+        last_stamp = now
+    return now.strftime("%Y%m%dT%H%M%S%f")
+
 def filebase(sequence):
-    return str(sequence) + '_' + datetime.datetime.now().strftime("%m%d%y%H%M%S")
+    # The timestamp comes first so names sort chronologically, the random suffix keeps parallel
+    # writers apart, and files are created exclusively so a clash fails instead of overwriting
+    return timestamp() + '_' + str(sequence) + '_' + uuid.uuid4().hex[:12]
+
+def compress_type(filename):
+    ext = os.path.splitext(filename)[1].lstrip('.').lower()
+    if COMPRESS_LEVEL > 0 and ext in DEFLATE_EXTS:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
 
 def write_data(filename, raw_data, location):
     if isinstance(location, zipfile.ZipFile):
-        location.writestr(filename, raw_data)
+        location.writestr(filename, raw_data, compress_type(filename), COMPRESS_LEVEL)
     elif isinstance(location, str):
-        with open(os.path.join(location, filename), 'wb') as file:
+        with open(os.path.join(location, filename), 'xb') as file:
             file.write(raw_data)
     else:
         raise TypeError("location must be ZipFile or string path")
 
-def pack_image(raw_data, location, sequence=1):
+def store_blob(raw_data, ext, capdir):
+    digest = hashlib.sha256(raw_data).hexdigest()
+    ref = '/'.join([BLOB_DIR, digest[:2], digest + '.' + ext])
+    path = os.path.join(capdir, ref)
+
+    try:
+        # an existing blob is touched, so collect_garbage sees it as new until the ref to it is written
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a private name and rename, so parallel writers of the same blob never see half of it
+        tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(tmp, 'xb') as file:
+            file.write(raw_data)
+        os.replace(tmp, path)
+
+    return ref
+
+def pack_image(raw_data, location, sequence=1, capdir=None):
     ext = filetype.guess_extension(raw_data)
     if ext is None:
         raise RuntimeError("Could not guess filetype")
 
     filename = filebase(sequence) + '.' + ext
-    write_data(filename, raw_data, location)
+    if DEDUP and capdir is not None:
+        write_data(filename + REF_EXT, store_blob(raw_data, ext, capdir).encode("utf-8"), location)
+    else:
+        write_data(filename, raw_data, location)
 
 def pack_text(text, location, sequence=1):
     filename = filebase(sequence) + '.txt'
     write_data(filename, text, location)
 
-def pack_caption(img_data, txt_data, location, sequence=1):
+def pack_caption(img_data, txt_data, location, sequence=1, capdir=None):
     loc_str = isinstance(location, str)
     loc_zip = isinstance(location, zipfile.ZipFile)
     if not loc_str and not loc_zip:
@@ -36,15 +94,16 @@ def pack_caption(img_data, txt_data, location, sequence=1):
 
     filename = filebase(sequence) + '.zip'
     if loc_str:
-        filename = os.path.join(location, filename)
-
-    with zipfile.ZipFile(filename, 'w') as zipFile:
-        pack_image(img_data, zipFile)
-        pack_text(txt_data, zipFile)
-
-    if loc_zip:
-        location.write(filename)
-        os.remove(filename)
+        with zipfile.ZipFile(os.path.join(location, filename), 'x') as zipFile:
+            pack_image(img_data, zipFile, capdir=location)
+            pack_text(txt_data, zipFile)
+    else:
+        # build the nested caption in memory and write it straight into the album
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zipFile:
+            pack_image(img_data, zipFile, capdir=capdir)
+            pack_text(txt_data, zipFile)
+        write_data(filename, buf.getvalue(), location)
 
 def pack_album(cap_list, location, sequence=1):
     if isinstance(location, zipfile.ZipFile):
@@ -52,9 +111,44 @@ def pack_album(cap_list, location, sequence=1):
 
     filename = os.path.join(location, filebase(sequence) + '.zip')
 
-    with zipfile.ZipFile(filename, 'w') as zipFile:
+    with zipfile.ZipFile(filename, 'x') as zipFile:
         for cap in cap_list:
-            cap.pack(zipFile)
+            cap.pack(zipFile, location)
+
+
+def referenced_blobs(zip, refs):
+    for name in zip.namelist():
+        if name.endswith(REF_EXT):
+            refs.add(zip.read(name).decode("utf-8").strip())
+        elif name.endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(zip.read(name))) as inner:
+                referenced_blobs(inner, refs)
+
+def collect_garbage(capdir, grace=3600):
+    # Remove blobs no cap in capdir refers to any more. Blobs younger than grace seconds are kept,
+    # since a pack running right now may have stored its blob but not written the ref yet.
+    refs = set()
+    with os.scandir(capdir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(REF_EXT):
+                with open(entry.path, "r") as file:
+                    refs.add(file.read().strip())
+            elif entry.name.endswith('.zip'):
+                with zipfile.ZipFile(entry.path) as zip:
+                    referenced_blobs(zip, refs)
+
+    keep = set(os.path.normpath(os.path.join(capdir, ref)) for ref in refs)
+    cutoff = time.time() - grace
+    removed = 0
+    for root, dirs, files in os.walk(os.path.join(capdir, BLOB_DIR)):
+        for name in files:
+            path = os.path.normpath(os.path.join(root, name))
+            if path not in keep and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    return removed
 
 
 class CapData:
@@ -67,16 +161,20 @@ class CapData:
         self.img_data = image
         self.txt_data = text
 
-    def pack(self, location):
+    def pack(self, location, capdir=None):
         hasImg = self.img_data is not None
         hasTxt = self.txt_data is not None
 
+        # capdir is where blobs go when dedup is on, needed when packing into an album
+        if isinstance(location, str):
+            capdir = location
+
         if not hasImg and not hasTxt:
             raise RuntimeError("Cannot pack null CapData")
         elif hasImg and hasTxt:
-            pack_caption(self.img_data, self.txt_data, location, self.sequence)
+            pack_caption(self.img_data, self.txt_data, location, self.sequence, capdir)
         elif hasImg:
-            pack_image(self.img_data, location, self.sequence)
+            pack_image(self.img_data, location, self.sequence, capdir)
         else:
             pack_text(self.txt_data, location, self.sequence)
 
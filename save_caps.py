@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
-import requests
+import fetch_caps
 import pack_caps
 import argparse
+import collections
+import csv
+import functools
 import glob
+import json
 import os
+import shutil
+import tempfile
+import time
 
 def get_img(filepath):
     image_url = input("Enter/Paste the URL for your image. Or leave blank for latest downloaded image.\n")
     if image_url:
-        data = requests.get(image_url)
-        return data.content
+        return fetch_caps.fetch(image_url)
     else:
         # get latest image in folder
         list_of_files = glob.glob(filepath + '/*')
@@ -121,11 +127,118 @@ def save_sequence(filepath):
 
         sequence += 1
 
+
+def read_manifest(manifest):
+    # JSONL or CSV (with a header) of entries with image (URL or path), text and album fields, all optional
+    with open(manifest, newline='') as file:
+        if os.path.splitext(manifest)[1].lower() == '.csv':
+            return list(csv.DictReader(file))
+        return [json.loads(line) for line in file if line.strip()]
+
+def read_file(source):
+    with open(source, "rb") as in_file:
+        return in_file.read()
+
+def read_download(future):
+    # bytes of a body streamed to a temporary file, which is removed once read
+    dest = future.result()
+    try:
+        return read_file(dest)
+    finally:
+        os.remove(dest)
+
+def fetch_in_order(fetcher, sources, window, tmpdir):
+    # Fetch concurrently but yield loaders in manifest order, with a bounded number in flight.
+    # Downloads are streamed into tmpdir and only read into memory when their entry is packed
+    pending = collections.deque()
+    for idx, source in enumerate(sources):
+        if not source:
+            pending.append(None)
+        elif source.startswith('http://') or source.startswith('https://'):
+            pending.append(functools.partial(read_download, fetcher.submit_to(source, os.path.join(tmpdir, str(idx)))))
+        else:
+            pending.append(functools.partial(read_file, source))
+
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+def save_manifest(manifest, filepath, jobs = 8, per_host = 4):
+    entries = read_manifest(manifest)
+    fetcher = fetch_caps.Fetcher(jobs, per_host)
+    tmpdir = tempfile.mkdtemp(prefix="save_caps_")
+
+    # albums are packed once their last entry is in
+    lastEntry = {}
+    for idx, entry in enumerate(entries):
+        if entry.get('album'):
+            lastEntry[entry['album']] = idx
+
+    start = time.time()
+    albums = {}
+    sequence = 1
+    packed = 0
+    images = 0
+    totalBytes = 0
+
+    for idx, (entry, load) in enumerate(zip(entries, fetch_in_order(fetcher, [e.get('image') for e in entries], 4 * jobs, tmpdir))):
+        try:
+            img_data = load() if load is not None else None
+            txt_data = bytes(entry['text'].strip(), "utf-8") if entry.get('text') else None
+            if img_data is None and txt_data is None:
+                raise RuntimeError("Entry has neither image nor text")
+
+            album = entry.get('album')
+            if album:
+                if album not in albums:
+                    albums[album] = pack_caps.AlbumData(sequence)
+                    sequence += 1
+                albums[album].append(img_data, txt_data)
+            else:
+                capData = pack_caps.CapData(sequence)
+                sequence += 1
+                capData.append(img_data, txt_data)
+                capData.pack(filepath)
+                packed += 1
+
+            if img_data is not None:
+                images += 1
+                totalBytes += len(img_data)
+        except Exception as e:
+            print("Error processing manifest entry " + str(idx + 1) + ":", e)
+
+        album = entry.get('album')
+        if album and lastEntry[album] == idx and album in albums:
+            try:
+                albums.pop(album).pack(filepath)
+                packed += 1
+            except Exception as e:
+                print("Error packing album " + album + ":", e)
+
+    fetcher.close()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+    elapsed = max(time.time() - start, 1e-6)
+    print("Packed %d caps (%d images, %.1f MB) in %.1f s: %.1f caps/sec, %.2f MB/sec" % (packed, images, totalBytes / 1e6, elapsed, packed / elapsed, totalBytes / 1e6 / elapsed))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Save collections of images and text.")
     parser.add_argument('--dirname', default="../Incoming", help='The directory the caps will be saved to')
+    parser.add_argument('--manifest', default=None, help='Save every cap in a JSONL or CSV manifest (fields image, text and album) without prompting')
+    parser.add_argument('--jobs', type=int, default=8, help='Number of concurrent downloads when saving a manifest')
+    parser.add_argument('--per-host', dest='per_host', type=int, default=4, help='Maximum concurrent downloads from a single host when saving a manifest')
+    parser.add_argument('--dedup', action='store_true', help='Store each distinct image once under ' + pack_caps.BLOB_DIR + ' in dirname and save references to it in the caps')
+    parser.add_argument('--compress-level', dest='compress_level', type=int, choices=range(10), default=pack_caps.COMPRESS_LEVEL, help='Deflate level (0-9) for caption text and uncompressed image formats (bmp, tif, psd, ico) inside caption and album zips. Already compressed images are stored as is.')
 
     args = parser.parse_args()
 
-    save_sequence(args.dirname)
+    pack_caps.COMPRESS_LEVEL = args.compress_level
+    pack_caps.DEDUP = args.dedup
+
+    if args.manifest is not None:
+        save_manifest(args.manifest, args.dirname, args.jobs, args.per_host)
+    else:
+        save_sequence(args.dirname)
 
@@ -1,11 +1,192 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import hashlib
+import io
+import json
 import os
+import shutil
 import signal
 import sqlite3
 import sys
+import time
+import zipfile
+
+import navigate_caps
+import pack_caps
+import view_caps
+
+
+# most matches a search opens in the viewer
+SEARCH_LIMIT = 1000
+
+# Each migration brings the schema up one version (tracked in PRAGMA user_version). Tables are only
+# created if missing, so databases set up by hand before this tool owned its schema are adopted,
+# as long as their tables have the columns in TABLE_COLUMNS (checked before the version is recorded).
+MIGRATIONS = [
+    [
+        """create table if not exists records (
+            id integer primary key,
+            title text)""",
+        """create table if not exists tags (
+            id integer primary key,
+            record_id integer not null references records(id) on delete cascade,
+            name text not null)""",
+        """create table if not exists record_entries (
+            id integer primary key,
+            record_id integer not null references records(id) on delete cascade,
+            idx integer not null)""",
+        """create table if not exists files (
+            id integer primary key,
+            entry_id integer not null references record_entries(id) on delete cascade,
+            filename text not null)""",
+        "create index if not exists tags_name on tags (name)",
+        "create index if not exists tags_record_id on tags (record_id)",
+        "create index if not exists record_entries_record_id_idx on record_entries (record_id, idx)",
+        "create index if not exists files_entry_id on files (entry_id)",
+        "create index if not exists files_filename on files (filename)",
+    ],
+    [
+        # caption text of each file, keyed by files.id, and dropped along with the file
+        "create virtual table if not exists file_text using fts5(body)",
+        """create trigger if not exists files_text_delete after delete on files begin
+            delete from file_text where rowid = old.id;
+        end""",
+    ],
+    [
+        # recorded when a file is saved, so check_integrity can catch size and content drift
+        "alter table files add column size integer",
+        "alter table files add column checksum text",
+    ],
+]
+
+# columns the code relies on, by table
+TABLE_COLUMNS = {
+    "records": ["id", "title"],
+    "tags": ["id", "record_id", "name"],
+    "record_entries": ["id", "record_id", "idx"],
+    "files": ["id", "entry_id", "filename"],
+}
+
+def check_tables(cursor):
+    for table, columns in TABLE_COLUMNS.items():
+        existing = [row[1] for row in cursor.execute("PRAGMA table_info(" + table + ")")]
+        missing = [column for column in columns if column not in existing]
+        if missing:
+            raise RuntimeError("Table " + table + " has columns (" + ", ".join(existing) + ") but needs " + ", ".join(missing)
+                + ". Rebuild it with those columns before using this database.")
+
+def configure(connection):
+    # WAL lets a viewer read while an ingest writes, and NORMAL sync is still crash safe under WAL
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute("PRAGMA cache_size = -65536")
+    connection.execute("PRAGMA temp_store = MEMORY")
+    connection.execute("PRAGMA foreign_keys = ON")
+
+def migrate(connection):
+    cursor = connection.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+        cursor.execute("begin")
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            check_tables(cursor)
+        except Exception:
+            connection.rollback()
+            raise
+        cursor.execute("PRAGMA user_version = " + str(number))
+        connection.commit()
+
+def hash_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def insert_file(cursor, entry_id, filename):
+    # read everything before inserting, so a file that can't be read leaves no row behind
+    size = os.path.getsize(filename)
+    checksum = hash_file(filename)
+    text = read_text(filename)
+    cursor.execute("insert into files (entry_id, filename, size, checksum) values (?, ?, ?, ?)",
+        (entry_id, filename, size, checksum))
+    if text:
+        cursor.execute("insert into file_text (rowid, body) values (?, ?)", (cursor.lastrowid, text))
+
+
+def zip_text(zip):
+    # text of every .txt member, including those of captions nested in an album
+    texts = []
+    for name in sorted(zip.namelist()):
+        _,ext = os.path.splitext(name)
+        if ext == '.txt':
+            texts.append(zip.read(name).decode("utf-8", errors="replace"))
+        elif ext == '.zip':
+            with zipfile.ZipFile(io.BytesIO(zip.read(name))) as inner:
+                texts.extend(zip_text(inner))
+    return texts
+
+def read_text(filename):
+    _,ext = os.path.splitext(filename)
+    if ext == '.txt':
+        with open(filename, "r", errors="replace") as file:
+            return file.read()
+    elif ext == '.zip':
+        with zipfile.ZipFile(filename) as zip:
+            return "\n".join(zip_text(zip))
+    return None
+
+def index_text(cursor, file_id, filename):
+    text = read_text(filename)
+    if text:
+        cursor.execute("insert into file_text (rowid, body) values (?, ?)", (file_id, text))
+
+def reindex_text(connection, cursor):
+    print("Rebuilding caption text index...")
+    cursor.execute("delete from file_text")
+    for file_id, filename in cursor.execute("select id, filename from files").fetchall():
+        try:
+            index_text(cursor, file_id, filename)
+        except Exception as e:
+            print("    Error indexing ", filename, ": ", e)
+    connection.commit()
+
+def quote_terms(query):
+    # every word as an FTS5 string, so punctuation like can't or foo-bar is searched for rather than parsed
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+def search(cursor, query, limit = SEARCH_LIMIT):
+    # filenames whose caption text matches an FTS5 query, or the plain words of it if it isn't valid FTS5 syntax.
+    # Ranked, so hitting the limit keeps the best matches
+    sql = """select files.filename from file_text join files on files.id = file_text.rowid
+        where file_text match ? order by rank limit ?"""
+    try:
+        rows = cursor.execute(sql, (query, limit)).fetchall()
+    except sqlite3.OperationalError:
+        rows = cursor.execute(sql, (quote_terms(query), limit)).fetchall()
+    # the same filename can be stored more than once, the viewer needs each file once.
+    # Also whether the limit cut the matches short
+    return list(dict.fromkeys(row[0] for row in rows)), len(rows) >= limit
+
+
+def open_database(filename):
+    connection = sqlite3.connect(filename, timeout=30)
+    configure(connection)
+    migrate(connection)
+    return connection
+
+
+def latest_file():
+    # newest file in the data dir, one scandir pass instead of a stat per listed name
+    with os.scandir() as entries:
+        return max((entry for entry in entries if entry.is_file()), key=lambda entry: entry.stat().st_ctime).name
+
 
 def save_sequence(connection, cursor):
     while True:
@@ -65,10 +246,10 @@ def save_sequence(connection, cursor):
                                 print("        Error during file construction: Invlid path ", image_path)
                                 continue
                         else:
-                            filename = max(os.listdir(), key=os.path.getctime)
+                            filename = latest_file()
                             print("        Using ", filename)
 
-                        cursor.execute("insert into files (entry_id, filename) values (?, ?)", (entry_id, filename))
+                        insert_file(cursor, entry_id, filename)
                     except Exception as e:
                         print("        Error during file construction: ", e)
                         continue
@@ -96,7 +277,7 @@ def save_sequence(connection, cursor):
                         with open(filename, 'w') as file:
                             file.write(output)
 
-                        cursor.execute("insert into files (entry_id, filename) values (?, ?)", (entry_id, filename))
+                        insert_file(cursor, entry_id, filename)
                     except Exception as e:
                         print("        Error during file construction: ", e)
                         continue
@@ -123,18 +304,172 @@ def save_sequence(connection, cursor):
             connection.commit()
 
 
-def check_integrity(connection, cursor):
+def copy_cap(source, filename):
+    # copy a cap into the data dir along with any deduplicated blobs it refers to
+    path = os.path.join(source, filename)
+    refs = set()
+    if filename.endswith(pack_caps.REF_EXT):
+        with open(path, "r") as file:
+            refs.add(file.read().strip())
+    elif filename.endswith('.zip'):
+        with zipfile.ZipFile(path) as zip:
+            pack_caps.referenced_blobs(zip, refs)
+
+    for ref in refs:
+        if not os.path.exists(ref):
+            os.makedirs(os.path.dirname(ref), exist_ok=True)
+            shutil.copy2(os.path.join(source, ref), ref)
+    if not os.path.exists(filename):
+        shutil.copy2(path, filename)
+    elif hash_file(filename) != hash_file(path):
+        # blobs are named by content, but caps with older, second resolution names can clash
+        raise FileExistsError("A different file named " + filename + " is already in the data dir")
+
+def scan_cap(source, filename):
+    # everything the import needs to know about one cap, read in a worker thread
+    if os.path.abspath(source) != os.getcwd():
+        copy_cap(source, filename)
+    if filename.endswith(pack_caps.REF_EXT):
+        kind = 'image'
+    else:
+        kind = navigate_caps.describe(filename)[0]
+    return filename, kind, os.path.getsize(filename), hash_file(filename), read_text(filename)
+
+def import_batch(cursor, caps):
+    # ids are handed out here rather than read back from lastrowid, so every table is one executemany
+    record_id = cursor.execute("select coalesce(max(id), 0) from records").fetchone()[0]
+    entry_id = cursor.execute("select coalesce(max(id), 0) from record_entries").fetchone()[0]
+    file_id = cursor.execute("select coalesce(max(id), 0) from files").fetchone()[0]
+
+    records, tags, entries, files, texts = [], [], [], [], []
+    for filename, kind, size, checksum, text in caps:
+        record_id += 1
+        entry_id += 1
+        file_id += 1
+        records.append((record_id, os.path.splitext(filename)[0]))
+        tags.append((record_id, kind))
+        entries.append((entry_id, record_id, 0))
+        files.append((file_id, entry_id, filename, size, checksum))
+        if text:
+            texts.append((file_id, text))
+
+    cursor.executemany("insert into records (id, title) values (?, ?)", records)
+    cursor.executemany("insert into tags (record_id, name) values (?, ?)", tags)
+    cursor.executemany("insert into record_entries (id, record_id, idx) values (?, ?, ?)", entries)
+    cursor.executemany("insert into files (id, entry_id, filename, size, checksum) values (?, ?, ?, ?, ?)", files)
+    cursor.executemany("insert into file_text (rowid, body) values (?, ?)", texts)
+    return len(records) + len(tags) + len(entries) + len(files) + len(texts)
+
+def import_directory(connection, cursor, source, batch = 5000, jobs = 8):
+    # Turn every cap in source that isn't in the files table yet into a record titled after the file,
+    # tagged with its kind (image, text, caption or album) and holding one entry with the cap in it.
+    # Caps outside the data dir are copied in first. Each batch of caps is one transaction.
+    print("Importing caps from", source, "...")
+    pool = concurrent.futures.ThreadPoolExecutor(jobs)
+    lookup = connection.cursor()
+    start = time.time()
+    imported = 0
+    rows = 0
+
+    # names start with their timestamp, so sorting them hands out record ids in the order caps were made
+    with os.scandir(source) as entries:
+        names = sorted(entry.name for entry in entries if not entry.name.startswith('.') and entry.is_file())
+
+    for first in range(0, len(names), batch):
+        todo = [name for name in names[first:first + batch]
+            if lookup.execute("select 1 from files where filename = ? limit 1", (name,)).fetchone() is None]
+        if not todo:
+            continue
+
+        caps = []
+        for name, future in [(name, pool.submit(scan_cap, source, name)) for name in todo]:
+            try:
+                caps.append(future.result())
+            except Exception as e:
+                print("    Error importing ", name, ": ", e)
+
+        cursor.execute("begin immediate")
+        rows += import_batch(cursor, caps)
+        connection.commit()
+
+        imported += len(caps)
+        print("    %d caps, %d rows, %.1f rows/sec" % (imported, rows, rows / max(time.time() - start, 1e-6)))
+
+    pool.shutdown()
+    print("Imported", imported, "caps")
+
+
+class IntegrityReport:
+    # Problems go to a JSON lines file if one is given, otherwise they are printed
+    def __init__(self, filename = None):
+        self.counts = collections.Counter()
+        self.file = open(filename, "w") if filename is not None else None
+
+    def add(self, problem, filename, **details):
+        self.counts[problem] += 1
+        if self.file is not None:
+            self.file.write(json.dumps(dict(problem=problem, filename=filename, **details)) + "\n")
+        else:
+            print("    ", problem, filename, details if details else "")
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(json.dumps({"summary": dict(self.counts)}) + "\n")
+            self.file.close()
+
+
+def check_checksums(pending, limit, problems):
+    # collect finished checksums, oldest first, until at most limit are in flight
+    while len(pending) > limit:
+        filename, checksum, future = pending.popleft()
+        try:
+            actual = future.result()
+            if actual != checksum:
+                problems.add("checksum", filename, expected=checksum, actual=actual)
+        except OSError as e:
+            problems.add("unreadable", filename, error=str(e))
+
+
+def check_integrity(connection, cursor, verify = False, report = None, jobs = 8):
     print("Checking integrity...")
-    # Compare files in DB to files in data dir
-    # The lists of all files in data directory and all files in files table are the same size
-    dir_list = os.listdir()
-    db_list = [row[1] for row in cursor.execute("select * from files").fetchall()]
-    dir_only_set = set(dir_list) - set(db_list)
-    db_only_set = set(db_list) - set(dir_list)
-    if dir_only_set or db_only_set:
+    # Compare files in DB to files in data dir without holding either list in memory: every file
+    # in the data dir is looked up through the filename index, then the files table is streamed
+    # in order and each row is checked against the data dir. Rows saved before sizes and
+    # checksums were recorded are only checked for presence.
+    problems = IntegrityReport(report)
+
+    lookup = connection.cursor()
+    with os.scandir() as entries:
+        for entry in entries:
+            if entry.is_file() and lookup.execute("select 1 from files where filename = ? limit 1", (entry.name,)).fetchone() is None:
+                problems.add("dir_only", entry.name)
+
+    pool = concurrent.futures.ThreadPoolExecutor(jobs) if verify else None
+    pending = collections.deque()
+
+    rows = connection.cursor().execute("select filename, size, checksum from files order by filename")
+    for filename, size, checksum in rows:
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            problems.add("db_only", filename)
+            continue
+
+        if size is not None and st.st_size != size:
+            problems.add("size", filename, expected=size, actual=st.st_size)
+        elif pool is not None and checksum is not None:
+            pending.append((filename, checksum, pool.submit(hash_file, filename)))
+            check_checksums(pending, 4 * jobs, problems)
+
+    if pool is not None:
+        check_checksums(pending, 0, problems)
+        pool.shutdown()
+
+    problems.close()
+    if problems.counts:
         print("Error during integrity check: Mismatch between data dir and files table")
-        print("    Entries in data dir only: ", ", ".join(dir_only_set))
-        print("    Entries in files table only: ", ", ".join(db_only_set))
+        for problem, count in sorted(problems.counts.items()):
+            print("    ", problem, ": ", count)
 
 
 class SignalHandler:
@@ -153,21 +488,61 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Save collections of images and text using a SQLite database.")
     parser.add_argument("--db", default="./database.db", help="The filename of the SQLite database.")
     parser.add_argument("--data_dir", default="./data", help="The directory the files will be saved to")
+    parser.add_argument("--search", default=None, help="Open a viewer on the files whose caption text matches this FTS5 query instead of saving")
+    parser.add_argument("--browse", action="store_true", help="Open a viewer on the records instead of saving (q/e move between records, z/c between entries)")
+    parser.add_argument("--tag", default=None, help="With --browse, only show records with this tag")
+    parser.add_argument("--title", default=None, help="With --browse, only show records whose title contains this")
+    parser.add_argument("--check", action="store_true", help="Check the data dir against the files table instead of saving")
+    parser.add_argument("--verify", action="store_true", help="With --check, also compare file contents against their stored checksums")
+    parser.add_argument("--report", default=None, help="With --check, write problems to this JSON lines file instead of printing them")
+    parser.add_argument("--import", dest="import_dir", default=None, help="Add every cap in this directory (as written by pack_caps) that isn't in the database yet as a record, copying it into data_dir if needed")
+    parser.add_argument("--batch", type=int, default=5000, help="Number of caps written per transaction by --import")
+    parser.add_argument("--jobs", type=int, default=8, help="Number of files read and checksummed in parallel by --verify and --import")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the caption text index from the files in data_dir (needed once for files saved before it existed)")
 
     args = parser.parse_args()
 
     # Open connection
-    connection = sqlite3.connect(args.db)
+    try:
+        connection = open_database(args.db)
+    except (RuntimeError, sqlite3.Error) as e:
+        sys.exit("Error during initialization: " + str(e))
     cursor = connection.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON")
 
     # Handle signal
     signal.signal(signal.SIGINT, SignalHandler(connection, cursor))
 
+    # Paths given on the command line are relative to where we started
+    report = os.path.abspath(args.report) if args.report is not None else None
+    db = os.path.abspath(args.db)
+    import_dir = os.path.abspath(args.import_dir) if args.import_dir is not None else None
+
     # Enter data dir
     if not os.path.isdir(args.data_dir):
         print("Error during initialization: ", data_dir, " is not a directory")
         quit()
     os.chdir(args.data_dir)
 
-    save_sequence(connection, cursor)
+    if args.reindex:
+        reindex_text(connection, cursor)
+
+    if import_dir is not None:
+        import_directory(connection, cursor, import_dir, args.batch, args.jobs)
+    elif args.browse:
+        view_caps.capViewerFromDB(db, ".", args.tag, args.title)
+    elif args.check:
+        check_integrity(connection, cursor, args.verify, report, args.jobs)
+    elif args.search is not None:
+        try:
+            hits,truncated = search(cursor, args.search)
+        except sqlite3.OperationalError as e:
+            print("Error searching for", repr(args.search) + ":", e)
+            hits,truncated = [], False
+        if truncated:
+            print("Found at least", SEARCH_LIMIT, "matches, showing the best", len(hits), "files")
+        else:
+            print("Found", len(hits), "matches")
+        if hits:
+            view_caps.capViewerFromList([os.path.abspath(hit) for hit in hits])
+    else:
+        save_sequence(connection, cursor)
@@ -9,12 +9,21 @@ from PIL import ImageTk
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 import cv2
+import atexit
+import collections
+import concurrent.futures
+import io
 import os
+import queue
 import random
+import sqlite3
 import numpy
 import argparse
 import filetype
 import sys
+import tempfile
+import threading
+import time
 
 import navigate_caps
 
@@ -22,10 +31,27 @@ import navigate_caps
 # constants and enums
 BEGIN = "BEGIN"
 
+# bytes of decoded frames an animated image may keep, longer animations are decoded as they play
+ANIMATION_BUDGET = 256 * 1024 * 1024
+
+# thumbnails are fitted into THUMB_SIZE squares and laid out THUMB_MARGIN apart, with the most
+# recently drawn THUMB_MEMORY of them kept decoded
+THUMB_SIZE = 192
+THUMB_MARGIN = 8
+THUMB_MEMORY = 512
+
+# decoded video frames buffered ahead of playback, capped in frames and in bytes
+VIDEO_BUFFER_FRAMES = 8
+VIDEO_BUFFER_BYTES = 64 * 1024 * 1024
+
 
 class ImageManager():
     def __init__(self, filename):
+        self.source = filename
         self.image = Image.open(filename)
+        self.size = self.image.size
+        self.still = None
+        self.reduction = 1
         self.animated = False
         try:
             self.image.seek(1)
@@ -34,62 +60,255 @@ class ImageManager():
         except:
             self.animated = False
 
-    def get_raw_frame(self):
-        if self.animated:
-            try:
-                self.image.seek(self.image.tell() + 1)
-            except:
-                self.image.seek(0)
+        # Animations are decoded on the first pass into frames and durations, after which playback
+        # just steps through them. Animations over ANIMATION_BUDGET bytes keep decoding every tick.
+        self.frames = []
+        self.durations = []
+        self.frameBytes = 0
+        self.complete = False
+        self.streaming = False
+        self.index = -1
 
+    def convert_frame(self):
         # make an RGB copy of the image to return (gifs can't be opened in RGB)
         copy = Image.new("RGB", self.image.size, (255, 255, 255))
         copy.paste(self.image)
         return numpy.array(copy)
 
+    def get_raw_frame(self, scale = 1.0):
+        if not self.animated:
+            # still images never change, so they are only converted again when the scale needs another reduction
+            reduction = self.reduction_for(scale)
+            if self.still is None or reduction != self.reduction:
+                self.decode_still(reduction)
+            return self.still
+
+        if self.complete:
+            self.index = (self.index + 1) % len(self.frames)
+            return self.frames[self.index]
+
+        self.index += 1
+        if self.index > 0:
+            try:
+                self.image.seek(self.index)
+            except EOFError:
+                # back at the start, so the first pass is over
+                self.image.seek(0)
+                self.index = 0
+                if not self.streaming:
+                    self.complete = True
+                    return self.frames[0]
+
+        frame = self.convert_frame()
+        if not self.streaming:
+            self.store_frame(frame)
+        return frame
+
+    def reduction_for(self, scale):
+        # JPEGs decode at 1/2, 1/4 or 1/8 size for a fraction of the work, so take the smallest
+        # of those that still has a pixel for every pixel shown at this scale
+        if self.image.format != 'JPEG':
+            return 1
+        for reduction in [8, 4, 2]:
+            if scale * reduction <= 1:
+                return reduction
+        return 1
+
+    def decode_still(self, reduction):
+        # a decoded image can't be drafted again, so a new reduction means opening it again
+        if self.still is not None:
+            self.image.close()
+            if not isinstance(self.source, str):
+                self.source.seek(0)
+            self.image = Image.open(self.source)
+
+        if reduction > 1:
+            self.image.draft("RGB", (self.size[0] // reduction, self.size[1] // reduction))
+        self.still = None
+        self.still = self.convert_frame()
+        self.reduction = reduction
+
+    def store_frame(self, frame):
+        # runs of identical frames share one array, which also lets MediaManager skip redrawing them
+        if self.frames and numpy.array_equal(frame, self.frames[-1]):
+            frame = self.frames[-1]
+        else:
+            self.frameBytes += frame.nbytes
+
+        if self.frameBytes > ANIMATION_BUDGET:
+            self.streaming = True
+            self.frames = []
+            self.durations = []
+            return
+
+        self.frames.append(frame)
+        self.durations.append(self.image.info.get('duration'))
+
     def get_duration(self):
-        try:
-            if self.animated:
-                return self.image.info['duration']
-            else:
-                return None
-        except KeyError:
+        if not self.animated:
             return None
+        if self.complete:
+            return self.durations[self.index]
+        return self.image.info.get('duration')
 
     def __del__(self):
         self.image.close()
 
 
+# (stop event, thread) of every video decoder still running
+decoders = set()
+
+def stop_decoders():
+    # a decoder thread killed at exit in the middle of a read takes the process down with it
+    for stop,thread in list(decoders):
+        stop.set()
+    for stop,thread in list(decoders):
+        thread.join()
+
+atexit.register(stop_decoders)
+
+def put_frame(frames, item, stop):
+    # wait for room in the buffer, but give up if playback is stopped meanwhile
+    while not stop.is_set():
+        try:
+            frames.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def decode_frames(vcap, frames, stop, spool):
+    # Decoder thread of a VideoManager: queues (number, RGB frame) until stopped, going back to the
+    # start at the end of the stream so looping never waits on a seek. None is queued if the
+    # stream can't be read. The thread owns vcap and the spooled file and closes them itself.
+    number = 0
+    looped = 0
+    try:
+        while not stop.is_set():
+            ret, frame = vcap.read()
+            if not ret:
+                # a whole pass without a frame means the stream is broken
+                if number == looped:
+                    break
+                looped = number
+                vcap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                continue
+
+            put_frame(frames, (number, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)), stop)
+            number += 1
+    finally:
+        put_frame(frames, None, stop)
+        vcap.release()
+        if spool is not None:
+            spool.close()
+        decoders.discard((stop, threading.current_thread()))
+
+
 class VideoManager():
     def __init__(self, filename):
-        self.vcap = cv2.VideoCapture(filename)
-        if self.vcap.isOpened() == False:
+        # set before anything can fail, __del__ relies on it
+        self.stop = threading.Event()
+
+        spool = None
+        if not isinstance(filename, str):
+            # OpenCV can only open videos by name, so buffers are spooled to a temporary file
+            _,ext = os.path.splitext(getattr(filename, 'name', ''))
+            spool = tempfile.NamedTemporaryFile(suffix=ext)
+            filename.seek(0)
+            spool.write(filename.read())
+            spool.flush()
+            filename = spool.name
+
+        vcap = cv2.VideoCapture(filename)
+        if vcap.isOpened() == False:
+            vcap.release()
+            if spool is not None:
+                spool.close()
             raise ValueError("Unable to open video file", filename)
 
         # duration in miliseconds per frame
         self.framerate = None
-        fps = self.vcap.get(cv2.CAP_PROP_FPS)
-        if fps != 0:
-            self.framerate = int(1 / (fps/1000))
+        self.fps = vcap.get(cv2.CAP_PROP_FPS)
+        if self.fps != 0:
+            self.framerate = int(1 / (self.fps/1000))
+
+        frameBytes = max(1, int(vcap.get(cv2.CAP_PROP_FRAME_WIDTH) * vcap.get(cv2.CAP_PROP_FRAME_HEIGHT) * 3))
+        size = max(2, min(VIDEO_BUFFER_FRAMES, VIDEO_BUFFER_BYTES // frameBytes))
+
+        # decoding starts straight away, so a prefetched video has frames ready before it is shown
+        self.frames = queue.Queue(size)
+        thread = threading.Thread(target=decode_frames, args=(vcap, self.frames, self.stop, spool), daemon=True)
+        decoders.add((self.stop, thread))
+        thread.start()
+
+        # playback clock, started when the first frame is shown
+        self.start = None
+        self.number = -1
+        self.frame = None
+        self.dropped = 0
+        self.late = 0
+
+    def next_frame(self, block):
+        item = self.frames.get(block)
+        if item is None:
+            self.frames.put(None)
+            raise ValueError("Error with video stream")
+        return item
+
+    def get_raw_frame(self, scale = 1.0):
+        # Only dequeues, the decoder thread does the work. Frames the clock has already passed are
+        # dropped, and a frame that is due but not decoded yet leaves the last one up and counts as late.
+        if self.frame is None:
+            self.number,self.frame = self.next_frame(True)
+            self.start = time.monotonic()
+            return self.frame
+
+        if self.framerate is None:
+            due = self.number + 1
+        else:
+            due = int((time.monotonic() - self.start) * self.fps)
 
-    def get_raw_frame(self):
-        ret, frame = self.vcap.read()
+        taken = 0
+        while self.number < due:
+            try:
+                self.number,self.frame = self.next_frame(False)
+            except queue.Empty:
+                self.late += 1
+                break
+            taken += 1
 
-        if ret:
-            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        else:
-            self.vcap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-            ret, frame = self.vcap.read()
-            if ret:
-                return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            else:
-                raise ValueError("Error with video stream")
+        # every frame taken but the last went by without being shown
+        self.dropped += max(0, taken - 1)
+        return self.frame
 
     def get_duration(self):
         return self.framerate
 
+    def get_stats(self):
+        return self.dropped, self.late
+
     def __del__(self):
-        if self.vcap.isOpened():
-            self.vcap.release()
+        self.stop.set()
+
+
+def crop_resize(img, maxX, maxY, scrollX, scrollY, winX, winY):
+    # Same as resizing img to (maxX, maxY) and slicing out the window, but only the visible source region is resampled
+    outX = min(winX, maxX - scrollX)
+    outY = min(winY, maxY - scrollY)
+    if outX <= 0 or outY <= 0:
+        return numpy.zeros((max(outY, 0), max(outX, 0)) + img.shape[2:], img.dtype)
+
+    invX = img.shape[1] / maxX
+    invY = img.shape[0] / maxY
+
+    # source pixels under the window, plus a margin for interpolation
+    x0 = max(0, int((scrollX + 0.5) * invX - 0.5) - 1)
+    y0 = max(0, int((scrollY + 0.5) * invY - 0.5) - 1)
+    x1 = min(img.shape[1], int((scrollX + outX + 0.5) * invX) + 2)
+    y1 = min(img.shape[0], int((scrollY + outY + 0.5) * invY) + 2)
+
+    # map window pixels back onto the crop using cv2.resize's pixel center convention
+    M = numpy.array([[invX, 0, (scrollX + 0.5) * invX - 0.5 - x0], [0, invY, (scrollY + 0.5) * invY - 0.5 - y0]])
+    return cv2.warpAffine(img[y0:y1, x0:x1], M, (outX, outY), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
 
 
 class MediaManager:
@@ -104,32 +323,56 @@ class MediaManager:
         self.unscaledX = 0
         self.unscaledY = 0
 
+        # last rendered frame and the raw frame and view it was rendered from
+        self.frame = None
+        self.rawFrame = None
+        self.view = None
+
         self.manager = None
 
         ext = filetype.guess_extension(file)
         if ext is None:
-            print("Filetype of " + filename + " couldn't be detected, aborting")
+            print("Filetype of " + str(filename) + " couldn't be detected, aborting")
             file = "blank.jpg"
             ext = "jpg"
 
-        if ext in ['jfif', 'jpeg', 'jpg', 'JPG', 'png', 'webp']:
+        if ext in ['jfif', 'jpeg', 'jpg', 'JPG', 'png', 'webp', 'gif']:
             self.manager = ImageManager(file)
         else:
             self.manager = VideoManager(file)
 
     def get_frame(self, winX, winY):
-        img = self.manager.get_raw_frame();
+        # images may come back decoded at a fraction of their size when zoomed out, but the
+        # view is always laid out at full size and crop_resize scales whatever it is given
+        img = self.manager.get_raw_frame(self.scale)
 
-        self.unscaledX = img.shape[1]
-        self.unscaledY = img.shape[0]
+        if isinstance(self.manager, ImageManager):
+            self.unscaledX,self.unscaledY = self.manager.size
+        else:
+            self.unscaledX = img.shape[1]
+            self.unscaledY = img.shape[0]
 
         self.maxX = int(self.unscaledX * self.scale)
         self.maxY = int(self.unscaledY * self.scale)
 
-        resized = cv2.resize(img, (self.maxX, self.maxY))
-        sliced = resized[self.scrollY:self.scrollY+winY, self.scrollX:self.scrollX+winX]
+        # still images hand back the same raw frame every tick, so the last render holds until the view changes
+        view = (self.scale, self.scrollX, self.scrollY, winX, winY)
+        if img is self.rawFrame and view == self.view:
+            return self.frame
 
-        return sliced
+        self.frame = crop_resize(img, self.maxX, self.maxY, self.scrollX, self.scrollY, winX, winY)
+        self.rawFrame = img
+        self.view = view
+
+        return self.frame
+
+    def is_still(self):
+        return isinstance(self.manager, ImageManager) and not self.manager.animated
+
+    def preload(self):
+        # decode still images ahead of time, for use off the main thread
+        if self.is_still():
+            self.manager.get_raw_frame(self.scale)
 
     def get_duration(self):
         out = self.manager.get_duration()
@@ -174,10 +417,237 @@ class MediaManager:
             self.set_scrollX(int(propX * self.unscaledX * self.scale), winX)
 
 
+def load_cap(filename, subIdx):
+    imgfile,txtfile,subfiles = navigate_caps.read_cap(filename, subIdx)
+    media = MediaManager(imgfile)
+    media.preload()
+    return media, txtfile, subfiles
+
+
+class Prefetcher:
+    def __init__(self, size = 16, workers = 2):
+        self.size = size
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+        # (filename, subIdx) -> future of load_cap, least recently requested first
+        self.cache = collections.OrderedDict()
+
+    def request(self, keys):
+        for key in reversed(keys):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                self.cache[key] = self.pool.submit(load_cap, *key)
+
+        while len(self.cache) > self.size:
+            _,future = self.cache.popitem(last=False)
+            future.cancel()
+
+    def take(self, key):
+        # caps are stateful (scroll, zoom, playback), so each prefetched one is only handed out once
+        future = self.cache.get(key)
+        if future is None or not future.done():
+            return None
+
+        del self.cache[key]
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def clear(self):
+        for future in self.cache.values():
+            future.cancel()
+        self.cache.clear()
+
+    def shutdown(self):
+        self.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def make_thumbnail(filename):
+    # JPEG of the first image of a cap (the first member's, for albums)
+    imgfile,_,_ = navigate_caps.read_cap(filename)
+    try:
+        image = Image.open(imgfile)
+        image.draft("RGB", (THUMB_SIZE, THUMB_SIZE))
+        image = image.convert("RGB")
+    except Exception:
+        # videos and anything else PIL can't open are decoded the way the viewer would
+        image = Image.fromarray(MediaManager(imgfile).manager.get_raw_frame())
+
+    image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+class ThumbnailCache:
+    # SQLite store of thumbnails keyed by absolute path and mtime, so a cap is only thumbnailed again when it changes.
+    # The cache is shared between directories, so relative paths like ./0001.jpg would collide
+    def __init__(self, filename):
+        if filename != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("""create table if not exists thumbnails (
+            path text primary key,
+            mtime integer not null,
+            data blob not null)""")
+        self.pending = 0
+
+    def get(self, path, mtime):
+        row = self.cursor.execute("select mtime, data from thumbnails where path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != mtime:
+            return None
+        return row[1]
+
+    def put(self, path, mtime, data):
+        self.cursor.execute("insert or replace into thumbnails values (?, ?, ?)", (os.path.abspath(path), mtime, data))
+        self.pending += 1
+        if self.pending >= 100:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class ThumbnailGrid:
+    # Pages of thumbnails filling the window. Thumbnails missing from the cache are made in a worker
+    # pool, the current page first and then its neighbours, and drawn as they arrive.
+    def __init__(self, cachefile = None, workers = None):
+        self.cache = ThumbnailCache(cachefile if cachefile is not None else ":memory:")
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+        # path -> RGB array (None if it couldn't be made), least recently drawn first
+        self.thumbs = collections.OrderedDict()
+        # path -> (mtime, future of make_thumbnail)
+        self.pending = {}
+
+        self.version = 0
+        self.sheet = None
+        self.sheetKey = None
+
+    def layout(self, winX, winY):
+        cell = THUMB_SIZE + THUMB_MARGIN
+        return max(1, winX // cell), max(1, winY // cell)
+
+    def request(self, files, first, count, wanted):
+        for pos in range(max(first, 0), min(first + count, files.slot_count())):
+            filename = files[pos]
+            wanted.add(filename)
+            if filename is None or filename in self.thumbs or filename in self.pending:
+                continue
+
+            try:
+                mtime = os.stat(filename).st_mtime_ns
+            except OSError:
+                continue
+            data = self.cache.get(filename, mtime)
+            if data is None:
+                self.pending[filename] = (mtime, self.pool.submit(make_thumbnail, filename))
+            else:
+                self.add(filename, data)
+
+    def add(self, filename, data):
+        self.thumbs[filename] = None if data is None else numpy.array(Image.open(io.BytesIO(data)))
+        self.thumbs.move_to_end(filename)
+        while len(self.thumbs) > THUMB_MEMORY:
+            self.thumbs.popitem(last=False)
+        self.version += 1
+
+    def collect(self):
+        # move finished thumbnails into memory and the cache
+        for filename, (mtime, future) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[filename]
+            try:
+                data = future.result()
+                self.cache.put(filename, mtime, data)
+            except Exception as e:
+                print("Error making thumbnail for", filename, ":", e)
+                data = None
+            self.add(filename, data)
+
+    def is_loading(self):
+        return bool(self.pending)
+
+    def get_sheet(self, files, selected, winX, winY):
+        cols,rows = self.layout(winX, winY)
+        count = cols * rows
+        first = (selected // count) * count
+
+        # the page being shown, then the pages either side, and nothing that has scrolled away
+        self.collect()
+        wanted = set()
+        for page in [first, first + count, first - count]:
+            self.request(files, page, count, wanted)
+        for filename, (mtime, future) in list(self.pending.items()):
+            if filename not in wanted and future.cancel():
+                del self.pending[filename]
+
+        key = (first, selected, winX, winY, self.version)
+        if key == self.sheetKey:
+            return self.sheet
+
+        sheet = numpy.full((max(winY, 1), max(winX, 1), 3), 32, numpy.uint8)
+        cell = THUMB_SIZE + THUMB_MARGIN
+        for pos in range(first, min(first + count, files.slot_count())):
+            x = ((pos - first) % cols) * cell + THUMB_MARGIN // 2
+            y = ((pos - first) // cols) * cell + THUMB_MARGIN // 2
+            if pos == selected:
+                sheet[max(y - 3, 0):y + THUMB_SIZE + 3, max(x - 3, 0):x + THUMB_SIZE + 3] = (255, 200, 0)
+                sheet[y:y + THUMB_SIZE, x:x + THUMB_SIZE] = 32
+
+            thumb = self.thumbs.get(files[pos]) if files[pos] is not None else None
+            if thumb is None:
+                continue
+            self.thumbs.move_to_end(files[pos])
+            h,w = thumb.shape[:2]
+            top = y + (THUMB_SIZE - h) // 2
+            left = x + (THUMB_SIZE - w) // 2
+            sheet[top:top + h, left:left + w] = thumb
+
+        self.sheet = sheet
+        self.sheetKey = key
+        return self.sheet
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.cache.close()
+
+
 class VideoPlayerApp:
-    def __init__(self, root, dirname, filename, filelist = None):
+    def __init__(self, root, dirname, filename, filelist = None, inMemory = False, prefetchDepth = 2, indexFile = None, fileNav = None, thumbFile = None):
         self.root = root
 
+        # grid mode shows pages of thumbnails instead of the current cap (FileNavigator only)
+        self.thumbFile = thumbFile
+        self.grid = None
+        self.gridMode = False
+        self.gridIdx = 0
+
+        # a navigator passed in (such as a RecordNavigator) is browsed as is, without prefetching or deleting
+        self.canDelete = fileNav is None
+        if fileNav is not None:
+            prefetchDepth = 0
+
+        # still images are only redrawn on view changes, animations and videos on a timer
+        self.pendingUpdate = None
+        self.lastFrame = None
+        self.framesRendered = 0
+        self.framesSkipped = 0
+        self.framesDropped = 0
+        self.framesLate = 0
+        self.media = None
+
+        self.prefetchDepth = prefetchDepth
+        self.prefetcher = None
+        if prefetchDepth > 0:
+            self.prefetcher = Prefetcher(size=4*prefetchDepth + 4)
+
         m1 = tk.PanedWindow(root, borderwidth=16, sashrelief=tk.RAISED)
         m1.pack(fill=tk.BOTH, expand=True)
     
@@ -193,7 +663,9 @@ class VideoPlayerApp:
         root.update()
         m1.paneconfigure(self.imageLabel, width=(2*m1.winfo_width()/3))
 
-        self.fileNav = navigate_caps.FileNavigator(dirname, filelist)
+        self.fileNav = fileNav
+        if fileNav is None:
+            self.fileNav = navigate_caps.FileNavigator(dirname, filelist, inMemory, lazy=True, indexfile=indexFile)
 
         # select first file and make a manager for it
         if filename is None:
@@ -203,11 +675,13 @@ class VideoPlayerApp:
         else:
             imgfile,txtfile = self.fileNav.get_file_from_name(filename)
 
-        self.media = MediaManager(imgfile)
+        self.setMedia(MediaManager(imgfile))
         self.newText(txtfile)
+        self.prefetch()
 
         # register handlers
         root.bind("<Key>", self.onKey)
+        self.imageLabel.bind("<Configure>", self.redraw)
 
         # call update
         self.update()
@@ -215,35 +689,176 @@ class VideoPlayerApp:
     def get_filename(self):
         return self.fileNav.get_filename()
 
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        if self.grid is not None:
+            self.grid.close()
+
+    def prefetch(self):
+        if self.prefetcher is None:
+            return
+
+        # neighbours aren't known until the directory listing is done, so don't block startup on it
+        if not self.fileNav.is_listed():
+            self.root.after(100, self.prefetch)
+            return
+
+        # nearest caps first, both directions, plus the neighbouring album members
+        keys = []
+        for offset in range(1, self.prefetchDepth + 1):
+            for sign in [1, -1]:
+                keys.append((self.fileNav.files[self.fileNav.peek(sign*offset)], 0))
+                if self.fileNav.isSeq():
+                    keys.append((self.fileNav.albumfile, self.fileNav.peek_seq(sign*offset)))
+
+        self.prefetcher.request(keys)
+
+    def navigate(self, move, offset, seq = False):
+        cap = None
+        if self.prefetcher is not None:
+            if seq:
+                idx,subIdx = self.fileNav.idx, self.fileNav.peek_seq(offset)
+            else:
+                idx,subIdx = self.fileNav.peek(offset), 0
+            cap = self.prefetcher.take((self.fileNav.files[idx], subIdx))
+
+        if cap is None:
+            imgfile,txtfile = move()
+            self.setMedia(MediaManager(imgfile))
+        else:
+            media,txtfile,subfiles = cap
+            self.setMedia(media)
+            self.fileNav.jump(idx, subIdx, subfiles)
+
+        self.newText(txtfile)
+        self.prefetch()
+
     def update(self):
-        # Update image
-        img = self.media.get_frame(self.imageLabel.winfo_width(), self.imageLabel.winfo_height())
+        self.pendingUpdate = None
 
-        photoImg = ImageTk.PhotoImage(image=Image.fromarray(img))
-        self.imageLabel.configure(image=photoImg)
-        self.imageLabel.image = photoImg
+        # Update image, unless the frame is the one already on screen
+        if self.gridMode:
+            img = self.grid.get_sheet(self.fileNav.files, self.gridIdx, self.imageLabel.winfo_width(), self.imageLabel.winfo_height())
+        else:
+            img = self.media.get_frame(self.imageLabel.winfo_width(), self.imageLabel.winfo_height())
 
-        # Call update until we quit
-        self.root.after(self.media.get_duration(), self.update)
+        if img is self.lastFrame:
+            self.framesSkipped += 1
+        else:
+            photoImg = ImageTk.PhotoImage(image=Image.fromarray(img))
+            self.imageLabel.configure(image=photoImg)
+            self.imageLabel.image = photoImg
+            self.lastFrame = img
+            self.framesRendered += 1
+
+        # Keep updating moving media until we quit, still images wait for redraw, and the grid polls for thumbnails
+        if self.gridMode:
+            if self.grid.is_loading():
+                self.pendingUpdate = self.root.after(50, self.update)
+        elif not self.media.is_still():
+            self.pendingUpdate = self.root.after(self.media.get_duration(), self.update)
+
+    def redraw(self, event = None):
+        if self.pendingUpdate is not None:
+            self.root.after_cancel(self.pendingUpdate)
+        self.pendingUpdate = self.root.after_idle(self.update)
+
+    def setMedia(self, media):
+        # keep the video stats of the media being replaced
+        if self.media is not None and isinstance(self.media.manager, VideoManager):
+            dropped,late = self.media.manager.get_stats()
+            self.framesDropped += dropped
+            self.framesLate += late
+        self.media = media
+
+    def get_frame_stats(self):
+        return self.framesRendered, self.framesSkipped
+
+    def get_video_stats(self):
+        # video frames dropped and late so far, including the current media
+        dropped,late = self.framesDropped, self.framesLate
+        if isinstance(self.media.manager, VideoManager):
+            current = self.media.manager.get_stats()
+            dropped,late = dropped + current[0], late + current[1]
+        return dropped, late
 
     def newText(self, txtfile):
-        text = "Filename: " + self.fileNav.get_filename() + "\n"
+        text = ""
+        if isinstance(self.fileNav, navigate_caps.RecordNavigator):
+            text += "Record: " + str(self.fileNav.get_title()) + "\n"
+        text += "Filename: " + self.fileNav.get_filename() + "\n"
 
         opt_subfile_name = self.fileNav.get_sub_filename_if_seq()
         if opt_subfile_name is not None:
             text += "Subfile " + str(self.fileNav.subIdx) + ": " + opt_subfile_name + "\n"
 
         text += "\n"
-        with open(txtfile, "r") as file:
-            text += file.read()
-        
+        if isinstance(txtfile, str):
+            with open(txtfile, "r") as file:
+                text += file.read()
+        else:
+            txtfile.seek(0)
+            text += txtfile.read().decode("utf-8")
+
+        # kept to put back when leaving grid mode
+        self.capText = text
+        self.setText(text)
+
+    def setText(self, text):
         self.textBox.configure(state=tk.NORMAL)
         self.textBox.delete("1.0", tk.END)
         self.textBox.insert(tk.END, text)
         self.textBox.configure(state=tk.DISABLED)
 
+    def gridText(self):
+        cols,rows = self.grid.layout(self.imageLabel.winfo_width(), self.imageLabel.winfo_height())
+        pages = (self.fileNav.files.slot_count() + cols*rows - 1) // (cols*rows)
+        text = "Page " + str(self.gridIdx // (cols*rows) + 1) + " of " + str(pages) + "\n"
+        text += "Filename: " + self.fileNav.files[self.gridIdx] + "\n\n"
+        text += "w/a/s/d select, q/e change page, g or Enter to open"
+        self.setText(text)
+
+    def toggleGrid(self):
+        if not self.gridMode:
+            self.fileNav.sync_listing()
+            if self.grid is None:
+                self.grid = ThumbnailGrid(self.thumbFile)
+            self.gridIdx = self.fileNav.idx
+            self.gridMode = True
+            self.gridText()
+            return
+
+        self.gridMode = False
+        self.lastFrame = None
+        if self.gridIdx != self.fileNav.idx:
+            self.fileNav.idx = self.gridIdx
+            imgfile,txtfile = self.fileNav.get_current()
+            self.setMedia(MediaManager(imgfile))
+            self.newText(txtfile)
+            self.prefetch()
+        else:
+            self.setText(self.capText)
+
+    def onGridKey(self, event):
+        cols,rows = self.grid.layout(self.imageLabel.winfo_width(), self.imageLabel.winfo_height())
+        moves = {'a': -1, 'd': 1, 'w': -cols, 's': cols, 'q': -cols*rows, 'e': cols*rows}
+        if event.char in moves:
+            self.gridIdx = self.fileNav.files.step(self.gridIdx, moves[event.char])
+            self.gridText()
+        elif event.char in ['g', '\r']:
+            self.toggleGrid()
+
+        self.redraw()
+
     def onKey(self, event):
-        if event.char == 'w':
+        if self.gridMode:
+            self.onGridKey(event)
+            return
+
+        if event.char == 'g' and isinstance(self.fileNav, navigate_caps.FileNavigator):
+            self.toggleGrid()
+        elif event.char == 'w':
             self.media.scroll_vert(-10, self.imageLabel.winfo_height())
         elif event.char == 's':
             self.media.scroll_vert(10, self.imageLabel.winfo_height())
@@ -256,48 +871,63 @@ class VideoPlayerApp:
         elif event.char == 'f':
             self.media.zoom(-0.1, self.imageLabel.winfo_width(), self.imageLabel.winfo_height())
         elif event.char == 'q':
-            imgfile,txtfile = self.fileNav.get_prev()
-            self.media = MediaManager(imgfile)
-            self.newText(txtfile)
+            self.navigate(self.fileNav.get_prev, -1)
         elif event.char == 'e':
-            imgfile,txtfile = self.fileNav.get_next()
-            self.media = MediaManager(imgfile)
-            self.newText(txtfile)
-        elif event.char == 'z':
-            imgfile,txtfile = self.fileNav.get_prev_seq()
-            self.media = MediaManager(imgfile)
-            self.newText(txtfile)
-        elif event.char == 'c':
-            imgfile,txtfile = self.fileNav.get_next_seq()
-            self.media = MediaManager(imgfile)
-            self.newText(txtfile)
-        elif event.char == 'x':
+            self.navigate(self.fileNav.get_next, 1)
+        elif event.char == 'z' and self.fileNav.isSeq():
+            self.navigate(self.fileNav.get_prev_seq, -1, True)
+        elif event.char == 'c' and self.fileNav.isSeq():
+            self.navigate(self.fileNav.get_next_seq, 1, True)
+        elif event.char == 'x' and self.canDelete:
             if messagebox.askokcancel("Warning", "Deleting " + self.fileNav.get_filename() + " is permanent. Proceed?"):
+                if self.prefetcher is not None:
+                    self.prefetcher.clear()
                 imgfile,txtfile = self.fileNav.delete()
-                self.media = MediaManager(imgfile)
+                self.setMedia(MediaManager(imgfile))
                 self.newText(txtfile)
+                self.prefetch()
+
+        self.redraw()
 
 
-def capViewerFromDir(dirname, startFilename):
+def capViewerFromDir(dirname, startFilename, inMemory = False, prefetchDepth = 2, indexFile = None, thumbFile = None):
     root = tk.Tk()
     root.title("Viewer")
     root.geometry("1400x900")
 
-    app = VideoPlayerApp(root, dirname, startFilename)
+    app = VideoPlayerApp(root, dirname, startFilename, inMemory=inMemory, prefetchDepth=prefetchDepth, indexFile=indexFile, thumbFile=thumbFile)
 
     root.mainloop()
+    app.close()
 
     return app
 
 
-def capViewerFromList(filelist):
+def capViewerFromList(filelist, inMemory = False, prefetchDepth = 2):
     root = tk.Tk()
     root.title("Viewer")
     root.geometry("1400x900")
 
-    app = VideoPlayerApp(root, None, BEGIN, filelist)
+    app = VideoPlayerApp(root, None, BEGIN, filelist, inMemory, prefetchDepth)
 
     root.mainloop()
+    app.close()
+
+    return app
+
+
+def capViewerFromDB(dbfile, dirname = ".", tag = None, title = None, startFilename = None):
+    # browse the records of a save_to_db store, q/e move between records and z/c between their entries
+    root = tk.Tk()
+    root.title("Viewer")
+    root.geometry("1400x900")
+
+    fileNav = navigate_caps.RecordNavigator(dbfile, dirname, tag, title)
+    app = VideoPlayerApp(root, None, BEGIN if startFilename is None else startFilename, fileNav=fileNav)
+
+    root.mainloop()
+    app.close()
+    fileNav.close()
 
     return app
 
@@ -310,6 +940,11 @@ if __name__ == "__main__":
     parser.add_argument('--ignore-mark', dest='ignore_mark', action='store_true', help='Ignore the bookmark file. Other starting file options (like filename and begin) imply ignore-mark.')
     parser.add_argument('--bookmark', default='bookmark.txt', help='Bookmark file to use to determine starting file. If not present, default is random selection.')
     parser.add_argument('--no-marking', dest='no_marking', action='store_true', help='Do not write your final position to the bookmark.')
+    parser.add_argument('--in-memory', dest='in_memory', action='store_true', help='Read captions and album members straight from the zip instead of extracting them to tmp.')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of caps (and album members) to decode ahead of time in each direction. 0 disables prefetching.')
+    parser.add_argument('--stats', action='store_true', help='Print how many frames were rendered and skipped, and how many video frames were dropped or late, when the viewer closes.')
+    parser.add_argument('--index', default=None, help='SQLite index of dirname to start from instead of listing it, updated when the directory changes. Keep it outside dirname.')
+    parser.add_argument('--thumbs', default=os.path.join(os.path.expanduser("~"), ".cache", "caps", "thumbs.db"), help='SQLite file caching the thumbnails of grid mode (g), keyed by path and mtime. Keep it outside dirname.')
     parser.add_argument('--marking-file', dest='marking_file', default=None, help='File to write final position. Default is the value of --bookmark')
 
     args = parser.parse_args()
@@ -326,7 +961,13 @@ if __name__ == "__main__":
         with open(args.bookmark, "r") as markfile:
             startFilename = markfile.read().rstrip('\n')
 
-    app = capViewerFromDir(args.dirname, startFilename)
+    app = capViewerFromDir(args.dirname, startFilename, args.in_memory, args.prefetch, args.index, args.thumbs)
+
+    if args.stats:
+        rendered,skipped = app.get_frame_stats()
+        print("Frames rendered:", rendered, "skipped:", skipped)
+        dropped,late = app.get_video_stats()
+        print("Video frames dropped:", dropped, "late:", late)
 
     if not args.no_marking:
         markfileName = args.bookmark